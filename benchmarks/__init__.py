@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+# benchmarks of the connector hot paths, see run.py
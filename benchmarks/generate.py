@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import random
+import sqlite3
+import struct
+
+# synthetic GeoPackages for the benchmarks, written with sqlite3 only so that
+# files of millions of features are generated without GDAL
+
+SRS_ROWS = [
+    ("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+    ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+    ("WGS 84 geodetic", 4326, "EPSG", 4326,
+     'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],'
+     'AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+     'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]', None),
+]
+
+# features per transaction
+BATCH_SIZE = 50000
+
+_POINT = struct.Struct('<2sBBi' + 'BI2d')
+_POLYGON_HEADER = struct.Struct('<2sBBi4d' + 'BIII')
+
+
+def quoteId(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def pointBlob(x, y, srs_id=4326):
+    """ GeoPackage blob of a point, without envelope like OGR writes them """
+    return _POINT.pack(b'GP', 0, 0x01, srs_id, 1, 1, x, y)
+
+
+def squareBlob(x, y, size, srs_id=4326):
+    """ GeoPackage blob of a square polygon, with its envelope """
+    coords = (x, y, x + size, y, x + size, y + size, x, y + size, x, y)
+    return _POLYGON_HEADER.pack(b'GP', 0, 0x03, srs_id, x, x + size, y, y + size, 1, 3, 1, 5) + \
+        struct.pack('<10d', *coords)
+
+
+def createGeoPackage(path):
+    """ create an empty GeoPackage, return its sqlite3 connection """
+    conn = sqlite3.connect(path)
+    conn.isolation_level = None
+    conn.execute("PRAGMA application_id = 1196444487")  # 'GPKG'
+    conn.execute("PRAGMA user_version = 10200")
+    # nothing to recover from if the generation fails
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+
+    conn.execute("BEGIN")
+    conn.execute("""CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY,
+                        organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL,
+                        definition TEXT NOT NULL, description TEXT)""")
+    conn.executemany("INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", SRS_ROWS)
+    conn.execute("""CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL,
+                        identifier TEXT UNIQUE, description TEXT DEFAULT '',
+                        last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+                        min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+                        srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id))""")
+    conn.execute("""CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL,
+                        geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL,
+                        m TINYINT NOT NULL, CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name))""")
+    conn.execute("""CREATE TABLE gpkg_extensions (table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL,
+                        definition TEXT NOT NULL, scope TEXT NOT NULL,
+                        CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))""")
+    conn.execute("CREATE TABLE gpkg_ogr_contents (table_name TEXT NOT NULL PRIMARY KEY, feature_count INTEGER DEFAULT NULL)")
+    conn.execute("COMMIT")
+    return conn
+
+
+def addLayer(conn, name, features, columns=3, geometry='point', spatial_index=True, seed=0):
+    """ add a feature table of random geometries within lon/lat bounds, with
+        columns attribute fields cycling through integer, real and text.
+        The R-tree is filled but has no triggers: the files are meant to be read """
+    rand = random.Random(seed)
+    types = ["INTEGER", "REAL", "TEXT"]
+    fields = [("field_%d" % i, types[i % 3]) for i in range(columns)]
+
+    conn.execute("BEGIN")
+    conn.execute("CREATE TABLE %s (fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, geom %s%s)" % (
+        quoteId(name), geometry.upper(), "".join([", %s %s" % (quoteId(f), t) for f, t in fields])))
+    if spatial_index:
+        rtree = quoteId("rtree_%s_geom" % name)
+        conn.execute("CREATE VIRTUAL TABLE %s USING rtree(id, minx, maxx, miny, maxy)" % rtree)
+        conn.execute("""INSERT INTO gpkg_extensions VALUES (?, 'geom', 'gpkg_rtree_index',
+                            'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')""", (name, ))
+
+    insert = "INSERT INTO %s VALUES (?, ?%s)" % (quoteId(name), ", ?" * columns)
+    size = 0.01 if geometry == 'polygon' else 0
+    bounds = [float('inf'), float('inf'), float('-inf'), float('-inf')]
+    for start in range(0, features, BATCH_SIZE):
+        rows = []
+        boxes = []
+        for fid in range(start + 1, min(start + BATCH_SIZE, features) + 1):
+            x, y = rand.uniform(-180, 180 - size), rand.uniform(-90, 90 - size)
+            blob = squareBlob(x, y, size) if geometry == 'polygon' else pointBlob(x, y)
+            values = [fid, sqlite3.Binary(blob)]
+            for i in range(columns):
+                kind = i % 3
+                if kind == 0:
+                    values.append(rand.randint(0, 1000))
+                elif kind == 1:
+                    values.append(rand.random() * 1000)
+                else:
+                    values.append(u"value %d" % rand.randint(0, 100))
+            rows.append(values)
+            boxes.append((fid, x, x + size, y, y + size))
+
+        bounds = [min(bounds[0], min([box[1] for box in boxes])), min(bounds[1], min([box[3] for box in boxes])),
+                  max(bounds[2], max([box[2] for box in boxes])), max(bounds[3], max([box[4] for box in boxes]))]
+        conn.executemany(insert, rows)
+        if spatial_index:
+            conn.executemany("INSERT INTO %s VALUES (?, ?, ?, ?, ?)" % rtree, boxes)
+
+    if features == 0:
+        bounds = [None] * 4
+    conn.execute("""INSERT INTO gpkg_contents (table_name, data_type, identifier, min_x, min_y, max_x, max_y, srs_id)
+                        VALUES (?, 'features', ?, ?, ?, ?, ?, 4326)""", [name, name] + bounds)
+    conn.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', ?, 4326, 0, 0)", (name, geometry.upper()))
+    conn.execute("INSERT INTO gpkg_ogr_contents VALUES (?, ?)", (name, features))
+    conn.execute("COMMIT")
+
+
+def generate(path, features=1000, layers=1, columns=3, geometry='point', spatial_index=True):
+    """ write a GeoPackage of layers tables of features each, named layer_0... """
+    conn = createGeoPackage(path)
+    try:
+        for i in range(layers):
+            addLayer(conn, "layer_%d" % i, features, columns, geometry, spatial_index, seed=i)
+    finally:
+        conn.close()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+# time the connector hot paths on synthetic GeoPackages, without QGIS GUI:
+#
+#   python -m db_manager.db_plugins.geopackage.benchmarks.run --sizes 1000,1000000 -o after.json --baseline before.json
+#
+# "cold" timings are the first call on a new connection, "warm" ones the
+# same call again (metadata caches filled), the best of --repeat runs is kept
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import tempfile
+from argparse import ArgumentParser
+
+from PyQt4.QtCore import Qt, QModelIndex
+
+from .generate import generate
+
+DEFAULT_SIZES = "1000,10000,100000,1000000,10000000"
+TABLE = "layer_0"
+
+
+def variants(options):
+    """ return the files to generate: (name, generate() arguments) """
+    result = []
+    for size in [int(size) for size in options.sizes.split(",") if size]:
+        result.append(("points-%d" % size, dict(features=size)))
+    if options.polygons:
+        result.append(("polygons-%d" % options.polygons, dict(features=options.polygons, geometry='polygon')))
+    if options.wide_columns:
+        result.append(("wide-%d" % options.wide_columns, dict(features=10000, columns=options.wide_columns)))
+    if options.layers:
+        result.append(("layers-%d" % options.layers, dict(features=100, layers=options.layers)))
+    return result
+
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def connectorCalls(connector):
+    """ the connector methods timed, (name, function) """
+    table = (None, TABLE)
+    return [
+        ("getTables", lambda: connector.getTables()),
+        ("getTableFields", lambda: connector.getTableFields(table)),
+        ("getTableRowCount", lambda: connector.getTableRowCount(table)),
+        ("getTableExtent", lambda: connector.getTableExtent(table, "geom")),
+        ("getSqlDictionary", lambda: connector.getSqlDictionary()),
+    ]
+
+
+def openModel(table):
+    """ open the data model of the table view and read its first row """
+    model = table.tableDataModel(None)
+    model.data(model.index(0, 0), Qt.DisplayRole)
+    return model
+
+
+def scrollModel(model, rows):
+    """ read the rows page after page like a scrolling table view, up to
+        rows, then jump to the last row. Return the rows read """
+    while model.rowCount() < rows and model.canFetchMore(QModelIndex()):
+        model.fetchMore(QModelIndex())
+    count = min(rows, model.rowCount())
+    for row in range(0, count, model.PAGE_SIZE):
+        model.data(model.index(row, 0), Qt.DisplayRole)
+    if model.rowCount() > 0:
+        model.data(model.index(model.rowCount() - 1, 0), Qt.DisplayRole)
+    return count
+
+
+def benchmarkFile(path, options):
+    """ return operation -> {'cold': seconds, 'warm': seconds} """
+    from qgis.core import QgsDataSourceURI
+    from ..connector import GeopackageDBConnector
+    from ..plugin import GeopackageDBPlugin
+
+    uri = QgsDataSourceURI()
+    uri.setDatabase(path)
+    timings = {}
+
+    def record(name, kind, secs):
+        timings.setdefault(name, {}).setdefault(kind, []).append(secs)
+
+    for i in range(options.repeat):
+        secs, connector = timed(lambda: GeopackageDBConnector(uri))
+        record("connect", "cold", secs)
+        for name, func in connectorCalls(connector):
+            record(name, "cold", timed(func)[0])
+            record(name, "warm", timed(func)[0])
+
+    # the table view goes through the plugin objects
+    for i in range(options.repeat):
+        plugin = GeopackageDBPlugin(os.path.basename(path))
+        plugin.connectToUri(uri)
+        table = [tbl for tbl in plugin.database().tables() if tbl.name == TABLE][0]
+        secs, model = timed(lambda: openModel(table))
+        record("tableDataModel.open", "cold", secs)
+        record("tableDataModel.scroll", "cold", timed(lambda: scrollModel(model, options.scroll_rows))[0])
+
+    # last, VACUUM rewrites the file
+    for i in range(options.repeat):
+        record("runVacuum", "cold", timed(connector.runVacuum)[0])
+
+    return dict([(name, dict([(kind, min(values)) for kind, values in kinds.items()]))
+                 for name, kinds in timings.items()])
+
+
+def environment():
+    from osgeo import gdal
+    from qgis.core import QGis
+
+    return {
+        'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'gdal': gdal.__version__,
+        'qgis': QGis.QGIS_VERSION,
+    }
+
+
+def compare(baseline, results, out):
+    """ print the timings changing by more than 10% from the baseline """
+    old = dict([((r['variant'], name, kind), secs) for r in baseline['results']
+                for name, kinds in r['timings'].items() for kind, secs in kinds.items()])
+    for r in results['results']:
+        for name, kinds in sorted(r['timings'].items()):
+            for kind, secs in sorted(kinds.items()):
+                before = old.get((r['variant'], name, kind))
+                if before is None or before == 0 or abs(secs - before) < 0.1 * before:
+                    continue
+                out.write("%-20s %-24s %-5s %10.4fs -> %10.4fs (%+.0f%%)\n" % (
+                    r['variant'], name, kind, before, secs, 100.0 * (secs - before) / before))
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Benchmark the GeoPackage connector on synthetic files")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="feature counts of the point layers, "
+                        "comma separated (default %s)" % DEFAULT_SIZES)
+    parser.add_argument("--polygons", type=int, default=100000, help="features of the polygon layer, 0 to skip")
+    parser.add_argument("--wide-columns", type=int, default=200, help="columns of the wide table, 0 to skip")
+    parser.add_argument("--layers", type=int, default=500, help="tables of the many-layer file, 0 to skip")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per timing, the best one is kept")
+    parser.add_argument("--scroll-rows", type=int, default=100000, help="rows read by the scroll benchmark")
+    parser.add_argument("--work-dir", help="keep the generated files there and reuse them on next runs")
+    parser.add_argument("-o", "--output", help="JSON result file (default: stdout)")
+    parser.add_argument("--baseline", help="JSON result file of a previous run to compare with")
+    options = parser.parse_args(argv)
+
+    from qgis.core import QgsApplication
+
+    # no GUI: runs without display
+    app = QgsApplication([], False)
+    app.initQgis()
+
+    workDir = options.work_dir or tempfile.mkdtemp(prefix="gpkg-benchmarks-")
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+
+    results = {'environment': environment(), 'results': []}
+    try:
+        for name, args in variants(options):
+            path = os.path.join(workDir, name + ".gpkg")
+            generated = None
+            if not os.path.exists(path):
+                generated = timed(lambda: generate(path, **args))[0]
+            sys.stderr.write("%s...\n" % name)
+
+            results['results'].append({
+                'variant': name,
+                'features': args.get('features'),
+                'layers': args.get('layers', 1),
+                'columns': args.get('columns', 3),
+                'file_size': os.path.getsize(path),
+                'generate': generated,
+                'timings': benchmarkFile(path, options),
+            })
+    finally:
+        if options.work_dir is None:
+            shutil.rmtree(workDir, ignore_errors=True)
+        app.exitQgis()
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            compare(json.load(f), results, sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
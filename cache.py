@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ a dict bounded to max_size, dropping the least recently used entries.
+        The size of an entry is given by sizeof(value), 1 by default """
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof if sizeof is not None else (lambda value: 1)
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (value, size), oldest first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self._entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_size:
+                return  # would evict everything else
+
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                key, (value, size) = self._entries.popitem(last=False)
+                self.size -= size
+
+    def discard(self, match):
+        """ drop the entries whose key satisfies match(key) """
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+# Index of the GeoPackages of a directory tree, kept in a local SQLite file.
+# Browsing and searching only read the index, the GeoPackages are opened
+# (read-only, one per worker thread) when they are new or have changed.
+
+import os
+import sqlite3
+import threading
+from multiprocessing.pool import ThreadPool
+
+from osgeo import ogr, gdal
+
+
+class Catalog(object):
+    # files per transaction of the index
+    BATCH_SIZE = 100
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.isolation_level = None
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, error TEXT);
+            CREATE TABLE IF NOT EXISTS layers (path TEXT NOT NULL REFERENCES files (path), name TEXT NOT NULL,
+                data_type TEXT, geometry_type TEXT, srs_id INTEGER, feature_count INTEGER,
+                min_x REAL, min_y REAL, max_x REAL, max_y REAL);
+            CREATE INDEX IF NOT EXISTS layers_path ON layers (path);
+            CREATE INDEX IF NOT EXISTS layers_name ON layers (name COLLATE NOCASE);
+        """)
+
+    def close(self):
+        self.conn.close()
+
+    def scan(self, root, workers=8, progress=None):
+        """ update the index with the GeoPackages under root: new and changed
+            files (by mtime and size) are read by a pool of threads, removed
+            files are dropped. progress(done, total) stops the scan by
+            returning True. Return the number of files read """
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.lower().endswith('.gpkg'):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    found[path] = (st.st_mtime, st.st_size)
+
+        prefix = os.path.join(root, '')
+        with self._lock:
+            known = dict([(row[0], (row[1], row[2])) for row in self.conn.execute(
+                "SELECT path, mtime, size FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))])
+        changed = [path for path, stamp in found.items() if known.get(path) != stamp]
+        removed = [path for path in known if path not in found]
+
+        with self._lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("DELETE FROM layers WHERE path = ?", [(path, ) for path in removed])
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(path, ) for path in removed])
+            self.conn.execute("COMMIT")
+
+        pool = ThreadPool(workers)
+        done = 0
+        pending = []
+        try:
+            for result in pool.imap_unordered(readGeoPackage, changed):
+                pending.append(result)
+                done += 1
+                if len(pending) >= self.BATCH_SIZE:
+                    self._store(pending, found)
+                    pending = []
+                if progress is not None and progress(done, len(changed)) is True:
+                    break
+            self._store(pending, found)
+        finally:
+            pool.terminate()
+            pool.join()
+        return done
+
+    def _store(self, results, stamps):
+        """ write the layers read from a batch of files in one transaction """
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                for path, layers, error in results:
+                    self.conn.execute("DELETE FROM layers WHERE path = ?", (path, ))
+                    self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                                      (path, stamps[path][0], stamps[path][1], error))
+                    self.conn.executemany("INSERT INTO layers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                          [(path, ) + tuple(layer) for layer in layers])
+            except sqlite3.Error:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def search(self, text=None, geometry_type=None, srs_id=None, bbox=None, limit=1000):
+        """ return the layers matching every given criterion, from the index:
+                (path, name, data type, geometry type, srs id, feature count,
+                 min x, min y, max x, max y)
+            text is searched in the file and layer names, bbox = (xmin, ymin,
+            xmax, ymax) must intersect the layer extent """
+        conditions, args = [], []
+        if text:
+            # '_' and '%' in names are no wildcards
+            conditions.append("(l.name LIKE ? ESCAPE '\\' OR l.path LIKE ? ESCAPE '\\')")
+            text = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            args += ["%%%s%%" % text] * 2
+        if geometry_type:
+            conditions.append("l.geometry_type = ? COLLATE NOCASE")
+            args.append(geometry_type)
+        if srs_id is not None:
+            conditions.append("l.srs_id = ?")
+            args.append(srs_id)
+        if bbox is not None:
+            conditions.append("l.min_x <= ? AND l.max_x >= ? AND l.min_y <= ? AND l.max_y >= ?")
+            args += [bbox[2], bbox[0], bbox[3], bbox[1]]
+
+        where = "WHERE %s" % " AND ".join(conditions) if len(conditions) > 0 else ""
+        sql = "SELECT l.* FROM layers AS l %s ORDER BY l.path, l.name LIMIT %d" % (where, limit)
+        with self._lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def errors(self):
+        """ return the files that couldn't be read: (path, error) """
+        with self._lock:
+            return self.conn.execute("SELECT path, error FROM files WHERE error IS NOT NULL ORDER BY path").fetchall()
+
+
+def readGeoPackage(path):
+    """ read the layers of a GeoPackage from its metadata tables, return
+        (path, list of layers as stored in the index, error message) """
+    try:
+        return _readGeoPackage(path)
+    except Exception, e:
+        return path, [], unicode(e) or "error"
+
+
+def _readGeoPackage(path):
+    ds = gdal.OpenEx(path.encode('utf-8') if isinstance(path, unicode) else path, gdal.OF_VECTOR | gdal.OF_RASTER | gdal.OF_READONLY,
+                     allowed_drivers=['GPKG'])
+    if ds is None:
+        return path, [], gdal.GetLastErrorMsg() or "not a GeoPackage"
+
+    def rows(sql):
+        lyr = ds.ExecuteSQL(sql)
+        if lyr is None:
+            return []
+        try:
+            return [[feat.GetField(i) for i in range(feat.GetFieldCount())] for feat in lyr]
+        finally:
+            ds.ReleaseResultSet(lyr)
+
+    gdal.PushErrorHandler('CPLQuietErrorHandler')
+    try:
+        counts = dict([(name.lower(), count) for name, count in
+                       rows("SELECT table_name, feature_count FROM gpkg_ogr_contents")])
+        geometries = dict([(name.lower(), geom_type) for name, geom_type in
+                           rows("SELECT table_name, geometry_type_name FROM gpkg_geometry_columns")])
+
+        layers = []
+        for name, data_type, srs_id, min_x, min_y, max_x, max_y in rows(
+                "SELECT table_name, data_type, srs_id, min_x, min_y, max_x, max_y FROM gpkg_contents"):
+            count = counts.get(name.lower())
+            if count is None and data_type == 'features':
+                lyr = ds.GetLayerByName(str(name))
+                count = lyr.GetFeatureCount() if lyr is not None else None
+            layers.append((name, data_type, geometries.get(name.lower()), srs_id, count, min_x, min_y, max_x, max_y))
+    finally:
+        gdal.PopErrorHandler()
+    return path, layers, None
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+
+from PyQt4.QtCore import Qt
+from PyQt4.QtGui import QApplication, QDialog, QVBoxLayout, QHBoxLayout, QLineEdit, QPushButton, QTableWidget, \
+    QTableWidgetItem, QFileDialog, QAbstractItemView, QLabel
+
+from .catalog import Catalog
+from .tasks import runTask
+
+
+def catalogPath():
+    """ return the path of the catalog index, in the QGIS settings directory """
+    from qgis.core import QgsApplication
+
+    return os.path.join(unicode(QgsApplication.qgisSettingsDirPath()), "db_manager_gpkg_catalog.sqlite")
+
+
+class CatalogDialog(QDialog):
+    """ search the layers of the indexed GeoPackages, double click adds one to
+        the map. Only the index is read, the GeoPackages are opened by scans """
+    COLUMNS = ["File", "Layer", "Type", "Geometry", "SRS", "Features"]
+
+    def __init__(self, iface, parent=None):
+        QDialog.__init__(self, parent)
+        self.iface = iface
+        self.catalog = Catalog(catalogPath())
+        self._task = None
+        self._closed = False
+        self.setWindowTitle(self.tr("GeoPackage catalog"))
+
+        self.searchEdit = QLineEdit(self)
+        self.searchEdit.setPlaceholderText(self.tr("Search file and layer names"))
+        self.searchEdit.textChanged.connect(self.search)
+        scanButton = QPushButton(self.tr("Scan directory..."), self)
+        scanButton.clicked.connect(self.scanDirectory)
+
+        self.table = QTableWidget(0, len(self.COLUMNS), self)
+        self.table.setHorizontalHeaderLabels([self.tr(label) for label in self.COLUMNS])
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.cellDoubleClicked.connect(self.addLayer)
+        self.status = QLabel(self)
+
+        top = QHBoxLayout()
+        top.addWidget(self.searchEdit)
+        top.addWidget(scanButton)
+        layout = QVBoxLayout(self)
+        layout.addLayout(top)
+        layout.addWidget(self.table)
+        layout.addWidget(self.status)
+        self.resize(800, 500)
+
+        self.search()
+
+    def search(self, text=None):
+        rows = self.catalog.search(unicode(self.searchEdit.text()))
+        self.table.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row[:len(self.COLUMNS)]):
+                item = QTableWidgetItem(unicode(value) if value is not None else u"")
+                if j == 0:
+                    item.setToolTip(unicode(value))
+                self.table.setItem(i, j, item)
+        self.table.resizeColumnsToContents()
+        self.status.setText(self.tr("{0} layers").format(len(rows)))
+
+    def scanDirectory(self):
+        root = QFileDialog.getExistingDirectory(self, self.tr("Scan GeoPackages"))
+        if not root:
+            return
+
+        def finished(task):
+            self._task = None
+            if self._closed:
+                return
+            if task.error is not None:
+                self.status.setText(unicode(task.error))
+                return
+            self.search()
+            self.status.setText(self.tr("{0} files read, {1} layers").format(task.result, self.table.rowCount()))
+
+        self._task = runTask(lambda progress: self.catalog.scan(unicode(root), progress=progress),
+                             QApplication.translate("DBManagerPlugin", "Scanning GeoPackages..."), self, finished)
+
+    def closeCatalog(self):
+        """ stop a running scan, then close the index the scan writes to """
+        self._closed = True
+        task = self._task
+        if task is not None:
+            task.cancel()
+            task.wait()
+        self.catalog.close()
+
+    def addLayer(self, row, column):
+        path = unicode(self.table.item(row, 0).text())
+        name = unicode(self.table.item(row, 1).text())
+        if unicode(self.table.item(row, 2).text()) == "tiles":
+            self.iface.addRasterLayer(u"GPKG:%s:%s" % (path, name), name)
+        else:
+            self.iface.addVectorLayer(u"%s|layername=%s" % (path, name), name, "ogr")
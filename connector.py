@@ -20,34 +20,206 @@ email                   : cch@sourcepole.ch
  ***************************************************************************/
 """
 
+import os
+import re
+import sys
+import time
+import calendar
+import json
+import random
+import struct
+import sqlite3
+import binascii
+import threading
+from array import array
+
 from PyQt4.QtCore import QFile
-from PyQt4.QtGui import QApplication
+from PyQt4.QtGui import QApplication, QImage
 
 from ..connector import DBConnector
 from ..plugin import ConnectionError, DbError, Table
 
 from osgeo import ogr, gdal
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import geometry_blob
+from .cache import LRUCache
+
 def classFactory():
     return GeopackageDBConnector
 
 
+class OgrCursor(object):
+    """ DB-API like cursor over an OGR result layer, OGR and native SQLite
+        results are read the same way. Rows hold the attribute fields, with
+        features=True the FID first and the geometry type names last """
+    arraysize = 1
+
+    def __init__(self, conn, lyr, features=False):
+        self.conn = conn
+        self.lyr = lyr
+        self.features = features
+        self.description = None
+        if lyr is None:
+            return  # statement without result
+
+        defn = lyr.GetLayerDefn()
+        names = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+        self._fid = features and bool(lyr.GetFIDColumn())
+        self._geoms = defn.GetGeomFieldCount() if features else 0
+        if self._fid:
+            names.insert(0, lyr.GetFIDColumn())
+        names += [defn.GetGeomFieldDefn(i).GetName() for i in range(self._geoms)]
+        self.description = tuple([(name, None, None, None, None, None, None) for name in names])
+
+    def fetchone(self):
+        if self.lyr is None:
+            return None
+        feat = self.lyr.GetNextFeature()
+        if feat is None:
+            self.close()
+            return None
+
+        row = [feat.GetFID()] if self._fid else []
+        row += [feat.GetField(i) for i in range(feat.GetFieldCount())]
+        for i in range(self._geoms):
+            geom = feat.GetGeomFieldRef(i)
+            row.append(geom.GetGeometryName() if geom is not None else None)
+        return tuple(row)
+
+    def fetchmany(self, size=None):
+        rows = []
+        for i in range(size if size is not None else self.arraysize):
+            row = self.fetchone()
+            if row is None:
+                break
+            rows.append(row)
+        return rows
+
+    def fetchall(self):
+        return list(self)
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+    def close(self):
+        """ release the result set, the cursor is closed once exhausted """
+        if self.lyr is not None:
+            self.conn.ReleaseResultSet(self.lyr)
+            self.lyr = None
+
+
 class GeopackageDBConnector(DBConnector):
+    # read-only datasources kept open for reuse by new threads
+    READER_POOL_SIZE = 4
+    # prepared statements kept by each native SQLite reader
+    SQLITE_STATEMENT_CACHE = 256
+    # statements needing OGR: writes (the OGR writer keeps gpkg_ogr_contents and
+    # the extents in sync) and the SQL functions registered by OGR only. The
+    # bbox functions of the R-tree clauses are registered on the native
+    # connections too, so that such queries stay interruptible. Views calling
+    # OGR functions are run by OGR once SQLite failed, see _cursor()
+    READ_STATEMENTS = ("SELECT", "WITH", "PRAGMA", "EXPLAIN", "VALUES")
+    OGR_FUNCTIONS = re.compile(r"\b(ST_(?!(MinX|MaxX|MinY|MaxY|IsEmpty)\b)\w+|gpkg\w*|geopackage_version|"
+                               r"geos_version|proj4_version|spatialite_version|ogr_\w+|\w*SpatialIndex|"
+                               r"SridFromAuthCRS|ImportFromEPSG|RegisterGeometryExtension|AsGPB|GeomFromGPB|"
+                               r"CastAutomagic|Transform|SetSRID|GeometryType|Srid)\s*\(", re.I)
+    # rows per batch of getColumnBatches()
+    COLUMN_BATCH_SIZE = 65536
+    # memory used by the decoded tiles of getTiles()
+    TILE_CACHE_SIZE = 64 * 1024 * 1024
+    # target tiles per task of the overview workers, tiles per transaction
+    OVERVIEW_BLOCK_SIZE = 8
+    OVERVIEW_BATCH_SIZE = 256
+    # OGR field types read as NumPy arrays by getColumnBatches()
+    NUMERIC_FIELD_TYPES = (ogr.OFTInteger, ogr.OFTInteger64, ogr.OFTReal)
+    # side table of getColumnStatistics(), rows read per fetch and per sample block
+    STATISTICS_TABLE = 'dbmanager_column_statistics'
+    STATISTICS_BATCH_SIZE = 10000
+    STATISTICS_SAMPLE_BLOCK = 1000
+    # seconds between the computation of statistics and the write storing them
+    STATISTICS_STORE_DELAY = 2
+    # cells kept by the query result cache, results above the row limit aren't kept
+    RESULT_CACHE_SIZE = 2000000
+    RESULT_CACHE_ROWS = 100000
+    # queries returning a different result on each run are never cached
+    VOLATILE_SQL = re.compile(r"\b(random|randomblob|changes|total_changes|last_insert_rowid)\s*\(|'now'|"
+                              r"\bcurrent_(timestamp|date|time)\b", re.I)
+    # features per transaction of importData()
+    IMPORT_BATCH_SIZE = 100000
+    # CSV columns named like coordinates are read as point geometries
+    CSV_OPEN_OPTIONS = ['AUTODETECT_TYPE=YES', 'X_POSSIBLE_NAMES=x,lon*,long*', 'Y_POSSIBLE_NAMES=y,lat*']
+    # rows per progress report and Parquet row group of exportData()
+    EXPORT_BATCH_SIZE = 65536
+    # export format -> (OGR driver, layer creation options). The FlatGeobuf
+    # spatial index would keep an entry per feature in memory
+    EXPORT_FORMATS = {
+        'fgb': ('FlatGeobuf', ['SPATIAL_INDEX=NO']),
+        'parquet': ('Parquet', []),
+        'csv': ('CSV', ['GEOMETRY=AS_WKT']),
+    }
+
     def __init__(self, uri):
         DBConnector.__init__(self, uri)
         self.dbname = uri.database()
         self.connString = self._connectionInfo()
+
+        # thread id -> (generation, read-only datasource), see _readConnection()
+        self._readers = {}
+        self._idleReaders = []
+        self._readersGeneration = 0
+        self._poolLock = threading.Lock()
+        self._guiThread = threading.current_thread().ident
+        self._writer = None
+
+        # thread id -> native SQLite connection, see _nativeConnection()
+        self._natives = {}
+        self._idleNatives = []
         
         if not QFile.exists(self.dbname):
             raise ConnectionError(QApplication.translate("DBManagerPlugin", '"{0}" not found').format(self.dbname))
         try:
-            self.connection = ogr.Open(self.connString)
+            # the datasource of the GUI thread
+            self.connection = self._readConnection()
 
         except self.connection_error_types(), e:
             raise ConnectionError(e)
 
+        # table name -> (file stamp, row count)
+        self._row_counts = {}
+
+        # schema metadata: section -> key -> value, see _cachedMetadata()
+        self._meta_cache = {}
+        self._meta_stamp = None
+        self._meta_version = None
+        # the SQL window thread reads metadata too (index advisor), loaders
+        # call _cachedMetadata() again
+        self._meta_lock = threading.RLock()
+
+        # (table name, zoom, column, row) -> decoded tile, see getTiles()
+        self._tile_cache = LRUCache(self.TILE_CACHE_SIZE, lambda image: image.byteCount())
+        self._tile_stamp = None
+
+        # normalized sql -> (data version, header, rows), see getCachedResult()
+        self._result_cache = LRUCache(self.RESULT_CACHE_SIZE, lambda entry: len(entry[2]) * max(1, len(entry[1])))
+        self._version_conn = None
+        self._version_lock = threading.Lock()
+        # table name -> _dataVersionStamp() once its statistics were stored
+        self._statistics_stamps = {}
+
+        # see indexAdvisor()
+        self._indexAdvisor = None
+
         self._checkSpatial()
         self._checkRaster()
+        self.has_ogr_contents = self._hasTable('gpkg_ogr_contents')
 #        self._checkGeometryColumnsTable()
 #        self._checkRastersTable()
 
@@ -60,8 +232,8 @@ class GeopackageDBConnector(DBConnector):
         return self.has_spatial
 
     def _checkRaster(self):
-        """ check if it's a rasterite db """
-        self.has_raster = False  # self._checkRastersTable()
+        """ check if the db can contain tile pyramids """
+        self.has_raster = self._hasTable('gpkg_tile_matrix_set')
         return self.has_raster
 
     def _checkGeometryColumnsTable(self):
@@ -77,7 +249,7 @@ class GeopackageDBConnector(DBConnector):
 #            self.has_geopackage4 = False
 
 #        self.has_geometry_columns_access = self.has_geometry_columns
-        self.has_geometry_columns = False
+        self.has_geometry_columns = self._hasTable('gpkg_geometry_columns')
         self.has_geopackage4 = False
         return True
 
@@ -85,6 +257,400 @@ class GeopackageDBConnector(DBConnector):
         
         return ret and ret[0]
 
+    def _hasTable(self, name):
+        sql = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?"
+        try:
+            return self._fetchValue(sql, params=(name, )) > 0
+        except DbError:
+            return False
+
+    def _fileStamp(self):
+        """ return a value changing whenever the database file is written """
+        stamp = ()
+        for path in (self.dbname, self.dbname + "-wal"):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stamp += (st.st_mtime, st.st_size)
+        return stamp
+
+    def _openDatasource(self, update):
+        ds = ogr.Open(self.connString, update)
+        if ds is None:
+            raise ConnectionError(gdal.GetLastErrorMsg())
+        return ds
+
+    def _readConnection(self):
+        """ return the read-only datasource of the calling thread. OGR
+            datasources must not be shared between threads, so every thread
+            gets its own, datasources of finished threads are reused """
+        ident = threading.current_thread().ident
+        with self._poolLock:
+            entry = self._readers.get(ident)
+            if entry is not None and entry[0] == self._readersGeneration:
+                return entry[1]
+
+            # give back the datasources of finished threads
+            alive = set([t.ident for t in threading.enumerate()])
+            for tid in self._readers.keys():
+                if tid not in alive:
+                    generation, ds = self._readers.pop(tid)
+                    if generation == self._readersGeneration and len(self._idleReaders) < self.READER_POOL_SIZE:
+                        self._idleReaders.append(ds)
+
+            if entry is None and len(self._idleReaders) > 0:
+                ds = self._idleReaders.pop()
+            else:
+                # no reader yet or the schema changed since it was opened
+                ds = self._openDatasource(0)
+            self._readers[ident] = (self._readersGeneration, ds)
+            if ident == self._guiThread:
+                self.connection = ds
+        return ds
+
+    def _releaseReadConnection(self):
+        """ give the datasource and the native connection of the calling thread
+            back to the pool, worker threads not started by Python must call it
+            when they are done """
+        ident = threading.current_thread().ident
+        with self._poolLock:
+            entry = self._readers.pop(ident, None)
+            if entry is not None and entry[0] == self._readersGeneration and len(self._idleReaders) < self.READER_POOL_SIZE:
+                self._idleReaders.append(entry[1])
+            conn = self._natives.pop(ident, None)
+            if conn is not None and len(self._idleNatives) < self.READER_POOL_SIZE:
+                self._idleNatives.append(conn)
+
+    def _writeConnection(self):
+        """ return the datasource used to modify the database """
+        with self._poolLock:
+            if self._writer is None:
+                self._writer = self._openDatasource(1)
+        return self._writer
+
+    def _closeWriter(self):
+        """ close the writing datasource, it is opened again on next use """
+        with self._poolLock:
+            self._writer = None
+
+    def _resetReaders(self):
+        """ make the readers reopen their datasource, OGR doesn't notice
+            layers created or dropped through another connection """
+        with self._poolLock:
+            self._readersGeneration += 1
+            self._idleReaders = []
+
+    def _nativeConnection(self):
+        """ return the native SQLite connection of the calling thread, running
+            the read statements not needing OGR. Connections of finished
+            threads are reused like the OGR readers """
+        ident = threading.current_thread().ident
+        with self._poolLock:
+            conn = self._natives.get(ident)
+            if conn is not None:
+                return conn
+
+            alive = set([t.ident for t in threading.enumerate()])
+            for tid in self._natives.keys():
+                if tid not in alive:
+                    conn = self._natives.pop(tid)
+                    if len(self._idleNatives) < self.READER_POOL_SIZE:
+                        self._idleNatives.append(conn)
+
+            if len(self._idleNatives) > 0:
+                conn = self._idleNatives.pop()
+            else:
+                conn = self._openSqlite(self.SQLITE_STATEMENT_CACHE)
+                conn.execute("PRAGMA query_only = 1")
+            self._natives[ident] = conn
+        return conn
+
+    def _openSqlite(self, cached_statements=100):
+        """ open a native SQLite connection to the database file, used where
+            OGR can't do the job (progress, cancellation, bulk writes) """
+        try:
+            conn = sqlite3.connect(self.dbname, timeout=30, check_same_thread=False,
+                                   cached_statements=cached_statements)
+        except sqlite3.Error, e:
+            raise ConnectionError(e)
+        conn.isolation_level = None  # autocommit, transactions are explicit
+
+        # the GeoPackage functions used by the R-tree triggers
+        def envelopeFunc(i):
+            def func(blob):
+                env = geometry_blob.envelope(blob)
+                return env[i] if env is not None else None
+            return func
+        for i, name in enumerate(("ST_MinX", "ST_MaxX", "ST_MinY", "ST_MaxY")):
+            conn.create_function(name, 1, envelopeFunc(i))
+        conn.create_function("ST_IsEmpty", 1, self._stIsEmpty)
+        return conn
+
+    @staticmethod
+    def _rollbackSqlite(conn):
+        try:
+            conn.execute("ROLLBACK")
+        except sqlite3.Error:
+            pass  # no transaction active
+
+    @staticmethod
+    def _stIsEmpty(blob):
+        header = geometry_blob.parseHeader(blob)
+        if header is None:
+            return None
+        return int(header[2])
+
+    def _isNativeSql(self, sql):
+        """ return True if sql is a read statement SQLite runs without OGR """
+        words = sql.split(None, 1)
+        if len(words) == 0 or words[0].upper() not in self.READ_STATEMENTS:
+            return False
+        if words[0].upper() == "PRAGMA" and "=" in sql:
+            return False
+        return self.OGR_FUNCTIONS.search(sql) is None
+
+    def _cursor(self, sql, conn=None, params=None, features=False):
+        """ run sql and return a cursor on its result: a native SQLite cursor
+            for the catalog and attribute reads, an OgrCursor when the statement
+            needs OGR, when an OGR datasource is given or features are asked.
+            params (for '?' placeholders) are only bound natively """
+        if isinstance(sql, str):
+            sql = sql.decode('utf-8')
+        if conn is None and not features and self._isNativeSql(sql):
+            try:
+                return self._nativeConnection().execute(sql, params or ())
+            except sqlite3.Error, e:
+                if params or not self._needsOgr(e):
+                    raise DbError(e, sql)
+
+        if params:
+            raise DbError(QApplication.translate("DBManagerPlugin", "Parameters need a native SQLite statement"), sql)
+        conn = conn if conn is not None else self._readConnection()
+        return OgrCursor(conn, self._executeSql(sql, conn), features)
+
+    @staticmethod
+    def _needsOgr(error):
+        """ return True if a native statement failed on a function or module
+            only OGR provides, e.g. in a view created by createSpatialView() """
+        message = unicode(error)
+        return isinstance(error, sqlite3.OperationalError) and \
+            ("no such function" in message or "no such module" in message)
+
+    def _executeSql(self, sql, conn=None):
+        """ run sql through OGR, raise DbError if OGR reports a failure """
+        conn = conn if conn is not None else self._readConnection()
+        if isinstance(sql, unicode):
+            sql = sql.encode('utf-8')
+
+        gdal.ErrorReset()
+        lyr = conn.ExecuteSQL(sql)
+        if gdal.GetLastErrorType() >= gdal.CE_Failure:
+            if lyr is not None:
+                conn.ReleaseResultSet(lyr)
+            raise DbError(gdal.GetLastErrorMsg(), sql)
+        return lyr
+
+    def _fetchRows(self, sql, conn=None, params=None):
+        """ run sql and return the result as a list of tuples """
+        cursor = self._cursor(sql, conn, params)
+        try:
+            return [tuple(row) for row in cursor.fetchall()] if cursor.description is not None else []
+        except sqlite3.Error, e:
+            raise DbError(e, sql)
+        finally:
+            cursor.close()
+
+    def _iterQuery(self, sql, native=None, status=None):
+        """ run a statement of the SQL window and yield the column names, then
+            each row as a tuple. Reads SQLite can run alone go to native, a
+            sqlite3 connection the caller can interrupt(), geometries being
+            summarized. Other reads go to the OGR reader, geometries being
+            shown by their type name. Any other statement is run by the OGR
+            writer, status['changes'] is set to the rows it changed and every
+            cache is dropped. status['native'] tells whether the native
+            connection runs the statement. The result set is released when the generator is
+            exhausted or closed, so a caller can stop a query between two rows """
+        if isinstance(sql, str):
+            sql = sql.decode('utf-8')
+        words = sql.split(None, 1)
+        if len(words) == 0 or words[0].upper() not in ("SELECT", "WITH"):
+            conn = self._writeConnection()
+            try:
+                cursor = OgrCursor(conn, self._executeSql(sql, conn), True)
+                try:
+                    yield [column[0] for column in cursor.description] if cursor.description is not None else []
+                    for row in cursor:
+                        yield row
+                finally:
+                    cursor.close()
+                if status is not None:
+                    status['changes'] = self._fetchValue("SELECT changes()", conn)
+            finally:
+                self._invalidateAll()
+            return
+
+        cursor = None
+        if native is not None and self._isNativeSql(sql):
+            try:
+                cursor = native.execute(sql)
+            except sqlite3.Error, e:
+                if not self._needsOgr(e):
+                    raise DbError(e, sql)
+
+        if status is not None:
+            status['native'] = cursor is not None
+        if cursor is None:
+            cursor = self._cursor(sql, self._readConnection(), features=True)
+        try:
+            if cursor.description is None:
+                yield []  # statement without result
+                return
+            yield [column[0] for column in cursor.description]
+            if isinstance(cursor, OgrCursor):
+                for row in cursor:
+                    yield row
+            else:
+                for row in cursor:
+                    yield self._displayRow(row)
+        except sqlite3.Error, e:
+            raise DbError(e, sql)
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _displayRow(row):
+        """ replace the geometry blobs of a native row by their summary """
+        return tuple([geometry_blob.summarize([value])[0]
+                      if isinstance(value, buffer) and geometry_blob.parseHeader(value) is not None else value
+                      for value in row])
+
+    def _runsNatively(self, sql):
+        """ return True if _iterQuery() runs sql on the native connection, so
+            that it can be interrupted. A view needing OGR may still make it
+            fall back to OGR, see status['native'] """
+        words = sql.split(None, 1)
+        return len(words) > 0 and words[0].upper() in ("SELECT", "WITH") and self._isNativeSql(sql)
+
+    def _invalidateAll(self):
+        """ drop every cache, after a statement of unknown effect has been run """
+        self._resetReaders()
+        with self._meta_lock:
+            self._meta_cache = {}
+            self._meta_stamp = self._meta_version = None
+        self._row_counts.clear()
+        self.clearResultCache()
+
+    def _fetchValue(self, sql, conn=None, params=None):
+        """ run sql and return the first column of the first row """
+        cursor = self._cursor(sql, conn, params)
+        try:
+            row = cursor.fetchone() if cursor.description is not None else None
+        except sqlite3.Error, e:
+            raise DbError(e, sql)
+        finally:
+            cursor.close()
+        return row[0] if row is not None and len(row) > 0 else None
+
+    def getQueryPlan(self, sql):
+        """ return the details of the EXPLAIN QUERY PLAN rows of sql """
+        if isinstance(sql, str):
+            sql = sql.decode('utf-8')
+        try:
+            return [row[-1] for row in self._nativeConnection().execute(u"EXPLAIN QUERY PLAN " + sql)]
+        except sqlite3.Error, e:
+            raise DbError(e, sql)
+
+    def _cachedMetadata(self, section, key, loader):
+        """ return a schema metadata entry, calling loader() when it is not cached.
+            The cache is kept as long as the schema version doesn't change, the
+            schema version is only read again once the database file changed. """
+        with self._meta_lock:
+            stamp = self._fileStamp()
+            if stamp != self._meta_stamp:
+                version = self._fetchValue("PRAGMA schema_version")
+                if version != self._meta_version:
+                    self._meta_cache = {}
+                    if self._meta_version is not None:
+                        self._resetReaders()
+                self._meta_stamp, self._meta_version = stamp, version
+
+            entries = self._meta_cache.setdefault(section, {})
+            if key not in entries:
+                entries[key] = loader()
+            return entries[key]
+
+    def _invalidateMetadata(self, *tables):
+        """ drop the cached metadata of the given tables and the table list,
+            called after the connector changed the schema. The rest of the
+            cache is kept: the new schema version is taken as the cached one,
+            only changes made outside of the connector clear everything """
+        self._resetReaders()
+        with self._meta_lock:
+            self._meta_cache.pop('tables', None)
+            self._meta_cache.pop('dictionary', None)
+            self._meta_cache.pop('allfields', None)
+            self._meta_cache.pop('allindexes', None)
+            for table in tables:
+                schema, tablename = self.getSchemaTableName(table)
+                for entries in self._meta_cache.values():
+                    entries.pop(tablename, None)
+            self._meta_stamp = self._fileStamp()
+            self._meta_version = self._fetchValue("PRAGMA schema_version")
+
+    @staticmethod
+    def normalizeSql(sql):
+        """ return sql with the whitespace outside of literals collapsed and
+            without trailing semicolon, the key of the result cache """
+        parts = re.split(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")", unicode(sql).strip().rstrip(';').strip())
+        for i in range(0, len(parts), 2):
+            parts[i] = re.sub(r"\s+", " ", parts[i])
+        return u"".join(parts)
+
+    def _isCacheable(self, sql):
+        """ only the results of read-only, deterministic queries are cached """
+        words = sql.split(None, 1)
+        return len(words) > 0 and words[0].upper() in ("SELECT", "WITH", "VALUES") \
+            and self.VOLATILE_SQL.search(sql) is None
+
+    def _dataVersionStamp(self):
+        """ return a value changing whenever the data is modified: the file stamp
+            and PRAGMA data_version, which changes on each commit of any other
+            connection, even before the file is written back (WAL, same mtime) """
+        with self._version_lock:
+            try:
+                if self._version_conn is None:
+                    self._version_conn = sqlite3.connect(self.dbname, timeout=30, check_same_thread=False)
+                version = self._version_conn.execute("PRAGMA data_version").fetchone()[0]
+            except sqlite3.Error:
+                self._version_conn = None
+                version = None
+        return self._fileStamp(), version
+
+    def getCachedResult(self, sql):
+        """ return (header, rows) of the last run of sql, None if it isn't cached
+            or the data has been modified since """
+        key = self.normalizeSql(sql)
+        if not self._isCacheable(key):
+            return None
+        entry = self._result_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] != self._dataVersionStamp():
+            self._result_cache.discard(lambda k: k == key)
+            return None
+        return entry[1], entry[2]
+
+    def cacheResult(self, sql, version, header, rows):
+        """ keep the result of sql, version being _dataVersionStamp() read before
+            running it: a write made during the query invalidates the entry """
+        key = self.normalizeSql(sql)
+        if self._isCacheable(key) and len(rows) <= self.RESULT_CACHE_ROWS:
+            self._result_cache.put(key, (version, header, rows))
+
+    def clearResultCache(self):
+        self._result_cache.clear()
+
     def getInfo(self):
 #        c = self.connection
 #        c = c.ExecuteSQL("SELECT sqlite_version()")
@@ -99,7 +665,7 @@ class GeopackageDBConnector(DBConnector):
         if not self.has_spatial:
             return
 
-        c = self.connection
+        c = self._readConnection()
         try:
             c = c.ExecuteSQL("SELECT geopackage_version(), geos_version(), proj4_version()")
         except DbError:
@@ -138,6 +704,11 @@ class GeopackageDBConnector(DBConnector):
 
     def getTables(self, schema=None, add_sys_tables=False):
         """ get list of tables """
+        tables = self._cachedMetadata('tables', (schema, add_sys_tables),
+                                      lambda: self._getTables(schema, add_sys_tables))
+        return [list(tbl) for tbl in tables]
+
+    def _getTables(self, schema=None, add_sys_tables=False):
         tablenames = []
         items = []
 
@@ -151,7 +722,11 @@ class GeopackageDBConnector(DBConnector):
                       "geometry_columns_statistics", "geometry_columns_time",
                       "sql_statements_log","vector_layers", "vector_layers_auth", "vector_layers_field_infos", "vector_layers_statistics",
                       "views_geometry_columns_auth", "views_geometry_columns_field_infos", "views_geometry_columns_statistics",
-                      "virts_geometry_columns_auth", "virts_geometry_columns_field_infos", "virts_geometry_columns_statistics"
+                      "virts_geometry_columns_auth", "virts_geometry_columns_field_infos", "virts_geometry_columns_statistics",
+                      "gpkg_contents", "gpkg_spatial_ref_sys", "gpkg_geometry_columns", "gpkg_tile_matrix_set",
+                      "gpkg_tile_matrix", "gpkg_extensions", "gpkg_data_columns", "gpkg_data_column_constraints",
+                      "gpkg_metadata", "gpkg_metadata_reference", "gpkg_ogr_contents", "sqlite_stat3", "sqlite_stat4",
+                      self.STATISTICS_TABLE
                   ]
 
         try:
@@ -159,7 +734,7 @@ class GeopackageDBConnector(DBConnector):
             for tbl in vectors:
                 if not add_sys_tables and tbl[1] in sys_tables:
                     continue
-                tablenames.append(tbl.GetName())
+                tablenames.append(tbl[1])
                 items.append(tbl)
         except DbError:
             pass
@@ -174,25 +749,22 @@ class GeopackageDBConnector(DBConnector):
         except DbError:
             pass
 
-        c = self.connection
-
         if self.has_geometry_columns:
             # get the R*Tree tables
-            sql = "SELECT f_table_name, f_geometry_column FROM geometry_columns WHERE spatial_index_enabled = 1"
-            for idx_item in c.ExecuteSQL(sql):
-                sys_tables.append('idx_%s_%s' % idx_item)
-                sys_tables.append('idx_%s_%s_node' % idx_item)
-                sys_tables.append('idx_%s_%s_parent' % idx_item)
-                sys_tables.append('idx_%s_%s_rowid' % idx_item)
+            sql = "SELECT table_name, column_name FROM gpkg_geometry_columns"
+            for idx_item in self._fetchRows(sql):
+                sys_tables.append('rtree_%s_%s' % idx_item)
+                sys_tables.append('rtree_%s_%s_node' % idx_item)
+                sys_tables.append('rtree_%s_%s_parent' % idx_item)
+                sys_tables.append('rtree_%s_%s_rowid' % idx_item)
 
-        sql = "SELECT name, type FROM sqlite_master WHERE type IN ('table', 'view')"
+        sql = "SELECT name, type = 'view' FROM sqlite_master WHERE type IN ('table', 'view')"
 
-
-        for tbl in c:
+        for tbl in self._fetchRows(sql):
             if tablenames.count(tbl[0]) <= 0:
                 if not add_sys_tables and tbl[0] in sys_tables:
                     continue
-                item = [tbl]
+                item = list(tbl)
                 item.insert(0, Table.TableType)
                 items.append(item)
 
@@ -217,38 +789,18 @@ class GeopackageDBConnector(DBConnector):
         if not self.has_geometry_columns:
             return []
 
-        c = self.connection
-
-        if self.has_geopackage4:
-            cols = """CASE geometry_type % 10
-                                  WHEN 1 THEN 'POINT'
-                                  WHEN 2 THEN 'LINESTRING'
-                                  WHEN 3 THEN 'POLYGON'
-                                  WHEN 4 THEN 'MULTIPOINT'
-                                  WHEN 5 THEN 'MULTILINESTRING'
-                                  WHEN 6 THEN 'MULTIPOLYGON'
-                                  WHEN 7 THEN 'GEOMETRYCOLLECTION'
-                                  END AS gtype,
-                                  CASE geometry_type / 1000
-                                  WHEN 0 THEN 'XY'
-                                  WHEN 1 THEN 'XYZ'
-                                  WHEN 2 THEN 'XYM'
-                                  WHEN 3 THEN 'XYZM'
-                                  ELSE NULL
-                                  END AS coord_dimension"""
-        else:
-            cols = "g.type,g.coord_dimension"
-
-        # get geometry info from geometry_columns if exists
-        sql = """SELECT m.name, m.type = 'view', g.f_table_name, g.f_geometry_column, %s, g.srid
-                                                FROM sqlite_master AS m JOIN geometry_columns AS g ON upper(m.name) = upper(g.f_table_name)
+        # get geometry info from gpkg_geometry_columns
+        sql = """SELECT m.name, m.type = 'view', g.table_name, g.column_name, g.geometry_type_name,
+                                                CASE WHEN g.z > 0 AND g.m > 0 THEN 'XYZM'
+                                                     WHEN g.z > 0 THEN 'XYZ'
+                                                     WHEN g.m > 0 THEN 'XYM'
+                                                     ELSE 'XY' END, g.srs_id
+                                                FROM sqlite_master AS m JOIN gpkg_geometry_columns AS g ON upper(m.name) = upper(g.table_name)
                                                 WHERE m.type in ('table', 'view')
-                                                ORDER BY m.name, g.f_geometry_column""" % cols
-
-        c = c.ExecuteSQL(sql)
+                                                ORDER BY m.name, g.column_name"""
 
         items = []
-        for tbl in c:
+        for tbl in self._fetchRows(sql):
             item = list(tbl)
             item.insert(0, Table.VectorType)
             items.append(item)
@@ -257,116 +809,742 @@ class GeopackageDBConnector(DBConnector):
 
 
     def getRasterTables(self, schema=None):
-        """ get list of table with a geometry column
+        """ get list of tile pyramid tables
                 it returns:
                         name (table name)
                         type = 'view' (is a view?)
                         geometry_column:
-                                r.table_name (the prefix table name, use this to load the layer)
-                                r.geometry_column
+                                t.table_name (the table name in gpkg_tile_matrix_set, use this to load the layer)
+                                'tile_data'
                                 srid
         """
 
-        if not self.has_geometry_columns:
-            return []
         if not self.has_raster:
             return []
 
-        c = self.connection
-
-        # get geometry info from geometry_columns if exists
-        sql = """SELECT r.table_name||'_rasters', m.type = 'view', r.table_name, r.geometry_column, g.srid
-                                                FROM sqlite_master AS m JOIN geometry_columns AS g ON upper(m.name) = upper(g.f_table_name)
-                                                JOIN layer_params AS r ON upper(REPLACE(m.name, '_metadata', '')) = upper(r.table_name)
-                                                WHERE m.type in ('table', 'view') AND upper(m.name) = upper(r.table_name||'_metadata')
-                                                ORDER BY r.table_name"""
-
-        c = c.ExecuteSQL(sql)
+        sql = """SELECT m.name, m.type = 'view', t.table_name, 'tile_data', t.srs_id
+                                                FROM sqlite_master AS m JOIN gpkg_tile_matrix_set AS t ON upper(m.name) = upper(t.table_name)
+                                                WHERE m.type in ('table', 'view')
+                                                ORDER BY m.name"""
 
         items = []
-        for i, tbl in enumerate(c):
+        for tbl in self._fetchRows(sql):
             item = list(tbl)
             item.insert(0, Table.RasterType)
             items.append(item)
 
         return items
 
+    def getTileMatrices(self, table):
+        """ return the zoom levels of a tile table, from gpkg_tile_matrix:
+                (zoom level, matrix width, matrix height, tile width, tile height,
+                 pixel x size, pixel y size) """
+        schema, tablename = self.getSchemaTableName(table)
+        return self._cachedMetadata('tilematrix', tablename, lambda: self._getTileMatrices(tablename))
+
+    def _getTileMatrices(self, tablename):
+        sql = """SELECT zoom_level, matrix_width, matrix_height, tile_width, tile_height, pixel_x_size, pixel_y_size
+                                                FROM gpkg_tile_matrix WHERE lower(table_name) = lower(%s)
+                                                ORDER BY zoom_level""" % self.quoteString(tablename)
+        return self._fetchRows(sql)
+
+    def getTileMatrixSet(self, table):
+        """ return (srs id, min x, min y, max x, max y) of a tile table """
+        schema, tablename = self.getSchemaTableName(table)
+        sql = "SELECT srs_id, min_x, min_y, max_x, max_y FROM gpkg_tile_matrix_set WHERE lower(table_name) = lower(%s)" % (
+            self.quoteString(tablename))
+        rows = self._fetchRows(sql)
+        return rows[0] if len(rows) > 0 else None
+
+    def getTile(self, table, zoom, column, row):
+        """ return the decoded tile as a QImage, None if there's no such tile """
+        return self.getTiles(table, zoom, column, row, column, row).get((column, row))
+
+    def getTiles(self, table, zoom, min_column, min_row, max_column, max_row):
+        """ return the decoded tiles of a zoom level within the given column and
+            row range, as a dict (column, row) -> QImage. Decoded tiles are kept
+            in an LRU cache, the missing ones are read with a single query """
+        schema, tablename = self.getSchemaTableName(table)
+        stamp = self._fileStamp()
+        if stamp != self._tile_stamp:
+            self._tile_cache.clear()  # the tiles may have been written meanwhile
+            self._tile_stamp = stamp
+
+        tiles = {}
+        missing = False
+        for column in range(min_column, max_column + 1):
+            for row in range(min_row, max_row + 1):
+                image = self._tile_cache.get((tablename, zoom, column, row))
+                if image is not None:
+                    tiles[(column, row)] = image
+                else:
+                    missing = True
+        if not missing:
+            return tiles
+
+        sql = """SELECT tile_column, tile_row, hex(tile_data) FROM %s
+                                                WHERE zoom_level = %d AND tile_column BETWEEN %d AND %d AND tile_row BETWEEN %d AND %d""" % (
+            self.quoteId(tablename), zoom, min_column, max_column, min_row, max_row)
+        for column, row, data in self._fetchRows(sql):
+            if (column, row) in tiles or data is None:
+                continue
+            image = QImage.fromData(binascii.unhexlify(data))
+            if image.isNull():
+                continue  # not a PNG or JPEG tile
+            self._tile_cache.put((tablename, zoom, column, row), image)
+            tiles[(column, row)] = image
+        return tiles
+
+    def buildTileOverviews(self, table, resampling='average', processes=None, resume=True, progress=None):
+        """ build the zoom levels below the most detailed one of a tile table,
+            down to a single tile or zoom level 0. Blocks of tiles are resampled
+            by a pool of processes, the tiles are written through a single
+            connection in transactions of OVERVIEW_BATCH_SIZE tiles. With
+            resume the tiles already there are kept, otherwise the levels are
+            built again. progress(done, total) stops the build by returning
+            True, the tiles written so far are kept for a later resume.
+            Return False if it has been cancelled """
+        import multiprocessing
+        from . import overviews
+
+        if resampling not in overviews.RESAMPLING_METHODS:
+            raise DbError(QApplication.translate("DBManagerPlugin", 'Unknown resampling method "{0}"').format(resampling))
+
+        schema, tablename = self.getSchemaTableName(table)
+        matrices = dict((row[0], row) for row in self.getTileMatrices(table))
+        base = self._fetchValue("SELECT max(zoom_level) FROM %s" % self.quoteId(tablename))
+        if base is None or base not in matrices:
+            return True  # no tiles
+
+        # every level halves the resolution of the one above
+        levels = []
+        zoom, width, height, tile_width, tile_height, pixel_x, pixel_y = matrices[base]
+        while zoom > 0 and (width > 1 or height > 1):
+            zoom, width, height, pixel_x, pixel_y = zoom - 1, (width + 1) // 2, (height + 1) // 2, pixel_x * 2, pixel_y * 2
+            if zoom in matrices:
+                if abs(matrices[zoom][5] - pixel_x) > pixel_x * 1e-6 or matrices[zoom][3:5] != (tile_width, tile_height):
+                    break  # not a power of 2 pyramid from here
+                width, height = matrices[zoom][1:3]
+            levels.append((zoom, width, height, pixel_x, pixel_y))
+        if len(levels) == 0:
+            return True
+
+        if sys.platform == 'win32':
+            # the workers are new processes, they must not start QGIS
+            python = os.path.join(sys.exec_prefix, 'pythonw.exe')
+            if os.path.exists(python):
+                multiprocessing.set_executable(python)
+
+        conn = self._openSqlite()
+        pool = multiprocessing.Pool(processes)
+        quoted = self.quoteId(tablename)
+        try:
+            conn.execute("BEGIN")
+            for zoom, width, height, pixel_x, pixel_y in levels:
+                if zoom not in matrices:
+                    conn.execute("INSERT INTO gpkg_tile_matrix VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (tablename, zoom, width, height, tile_width, tile_height, pixel_x, pixel_y))
+            if not resume:
+                conn.execute("DELETE FROM %s WHERE zoom_level < ?" % quoted, (base, ))
+            conn.execute("COMMIT")
+
+            total = sum([level[1] * level[2] for level in levels])
+            done = 0
+            insert = "INSERT OR REPLACE INTO %s (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)" % quoted
+            step = self.OVERVIEW_BLOCK_SIZE
+            for zoom, width, height, pixel_x, pixel_y in levels:
+                blocks = [(self.dbname, tablename, zoom, (column, min(column + step, width) - 1),
+                           (row, min(row + step, height) - 1), tile_width, tile_height, resampling, resume)
+                          for row in range(0, height, step) for column in range(0, width, step)]
+
+                # a level is read once the one above is committed
+                pending = 0
+                conn.execute("BEGIN")
+                for count, tiles in pool.imap_unordered(overviews.renderBlock, blocks):
+                    conn.executemany(insert, [(zoom, column, row, sqlite3.Binary(data)) for column, row, data in tiles])
+                    pending += len(tiles)
+                    done += count
+                    if pending >= self.OVERVIEW_BATCH_SIZE:
+                        conn.execute("COMMIT")
+                        conn.execute("BEGIN")
+                        pending = 0
+                    if progress is not None and progress(done, total) is True:
+                        conn.execute("COMMIT")
+                        return False
+                conn.execute("COMMIT")
+
+            conn.execute("UPDATE gpkg_contents SET last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE lower(table_name) = lower(?)",
+                         (tablename, ))
+        except sqlite3.Error, e:
+            self._rollbackSqlite(conn)
+            raise DbError(e)
+        finally:
+            pool.terminate()
+            pool.join()
+            conn.close()
+            self._invalidateMetadata(table)
+        return True
+
     def getTableRowCount(self, table):
-        c = self.connection
-        sql = str("SELECT * FROM %s" % self.quoteId(table))
-        ret = c.ExecuteSQL(sql)
-        return ret.__len__() if ret is not None else None
+        """ return the number of rows in table, read from the OGR feature
+            count cache when possible """
+        schema, tablename = self.getSchemaTableName(table)
+        stamp = self._fileStamp()
+        cached = self._row_counts.get(tablename)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        count = self._cachedRowCount(tablename)
+        if count is None:
+            sql = "SELECT count(*) FROM %s" % self.quoteId(tablename)
+            count = self._fetchValue(sql)
+
+        self._row_counts[tablename] = (stamp, count)
+        return count
+
+    def _cachedRowCount(self, tablename):
+        """ get the row count without counting, None if no count is cached """
+        if self.has_ogr_contents:
+            # feature_count is NULL while it is not maintained (e.g. during bulk loads)
+            sql = "SELECT feature_count FROM gpkg_ogr_contents WHERE lower(table_name) = lower(%s)" % self.quoteString(tablename)
+            count = self._fetchValue(sql)
+            if count is not None and count >= 0:
+                return count
+
+        lyr = self._readConnection().GetLayerByName(str(tablename))
+        if lyr is not None:
+            count = lyr.GetFeatureCount(force=False)
+            if count >= 0:
+                return count
+        return None
+
+    def _invalidateRowCount(self, table):
+        schema, tablename = self.getSchemaTableName(table)
+        self._row_counts.pop(tablename, None)
 
     def getTableFields(self, table):
-        """ return list of columns in table """
-        conn = self.connection
-        sql = str(table[1])
-        c = conn.GetLayer(sql)
-        
-        if c:
-            feat = c.GetFeature(1)
-            count = feat.GetFieldCount()
-            data = []
-    
-            data.append((0, c.GetFIDColumn(), 'Integer', None, None, None))
-            data.append((1, c.GetGeometryColumn(), 'Geometry', None, None, None))
-            for i in range(count):
-                info = feat.GetFieldDefnRef(i)
-                data.append((feat.GetFieldIndex(info.GetName()) + 2, info.GetName(), info.GetTypeName(), None, None, None))
-            return data
-        return None
+        """ return list of columns in table:
+                (num, name, data type, not null, default, primary key)
+            read from the table definition, no row is read """
+        schema, tablename = self.getSchemaTableName(table)
+        return self._cachedMetadata('fields', tablename, lambda: self._getTableFields(tablename))
+
+    def _getTableFields(self, tablename):
+        # reuse the bulk field list if it has been read already
+        allfields = self._meta_cache.get('allfields', {}).get(None)
+        if allfields is not None and tablename in allfields:
+            return allfields[tablename]
+
+        sql = "PRAGMA table_info(%s)" % self.quoteId(tablename)
+        try:
+            rows = self._fetchRows(sql)
+        except DbError:
+            rows = []
+        if len(rows) > 0:
+            return rows
+
+        lyr = self._readConnection().GetLayerByName(str(tablename))
+        if lyr is None:
+            return []
+        return self._layerFields(lyr)
+
+    def _layerFields(self, lyr):
+        """ build the field list from the definition of an OGR layer """
+        defn = lyr.GetLayerDefn()
+        data = []
+        if lyr.GetFIDColumn():
+            data.append((len(data), lyr.GetFIDColumn(), 'INTEGER', 1, None, 1))
+        for i in range(defn.GetGeomFieldCount()):
+            info = defn.GetGeomFieldDefn(i)
+            data.append((len(data), info.GetName(), 'GEOMETRY', int(not info.IsNullable()), None, 0))
+        for i in range(defn.GetFieldCount()):
+            info = defn.GetFieldDefn(i)
+            data.append((len(data), info.GetName(), info.GetTypeName(), int(not info.IsNullable()), info.GetDefault(), 0))
+        return data
+
+    def getAllTableFields(self):
+        """ return the columns of every table and view at once, as a dict
+            table name -> list of columns like getTableFields() """
+        return self._cachedMetadata('allfields', None, self._getAllTableFields)
+
+    def _getAllTableFields(self):
+        sql = """SELECT m.name, p.cid, p.name, p.type, p."notnull", p.dflt_value, p.pk
+                                                FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p
+                                                WHERE m.type IN ('table', 'view')
+                                                ORDER BY m.name, p.cid"""
+        fields = {}
+        try:
+            for row in self._fetchRows(sql):
+                fields.setdefault(row[0], []).append(row[1:])
+        except DbError:
+            # no table-valued pragma functions (SQLite < 3.16), use the layer definitions
+            conn = self._readConnection()
+            for i in range(conn.GetLayerCount()):
+                lyr = conn.GetLayer(i)
+                fields[lyr.GetName()] = self._layerFields(lyr)
+        return fields
+
+    def getTableFidColumn(self, table):
+        """ return the name of the FID column of table, None if it has none """
+        schema, tablename = self.getSchemaTableName(table)
+        return self._cachedMetadata('fid', tablename, lambda: self._getTableFidColumn(tablename))
+
+    def _getTableFidColumn(self, tablename):
+        lyr = self._readConnection().GetLayerByName(str(tablename))
+        if lyr is None:
+            return None
+        return lyr.GetFIDColumn() or None
+
+    def getColumnStatistics(self, table, sample_rows=None, progress=None):
+        """ return the statistics of the columns of table, a dict column name ->
+            dict(count, nulls, blobs, distinct, min, max, mean, histogram),
+            computed in a single scan of the table. With sample_rows, tables
+            having more rows are profiled from blocks of rows spread over the
+            FID range, and the counts are extrapolated. The result is cached in
+            STATISTICS_TABLE until the data of the table change.
+            progress(done, total) stops the scan by returning True, None is
+            then returned """
+        cached = self.getCachedColumnStatistics(table)
+        if cached is not None and cached[0] and (cached[2] == 0 or sample_rows is not None):
+            return cached[3]
+
+        schema, tablename = self.getSchemaTableName(table)
+        version = self._dataVersion(table)
+        started = self._dataVersionStamp()
+        names = [fld[1] for fld in self.getTableFields(table)]
+        columns = ", ".join(map(self.quoteId, names))
+        fid = self.getTableFidColumn(table)
+        total = self.getTableRowCount(table) or 0
+
+        queries = [("SELECT %s FROM %s" % (columns, self.quoteId(tablename)), ())]
+        sampling = sample_rows is not None and fid is not None and total > sample_rows
+        if sampling:
+            queries = self._sampleQueries(tablename, columns, fid, sample_rows)
+            total = sample_rows
+
+        from . import profiler
+        profiles = [profiler.ColumnProfile(name) for name in names]
+        conn = self._openSqlite()
+        try:
+            done = 0
+            for sql, args in queries:
+                cursor = conn.execute(sql, args)
+                while True:
+                    rows = cursor.fetchmany(self.STATISTICS_BATCH_SIZE)
+                    if len(rows) == 0:
+                        break
+                    for row in rows:
+                        for profile, value in zip(profiles, row):
+                            profile.add(value)
+                    done += len(rows)
+                    if progress is not None and progress(done, total) is True:
+                        return None
+
+            sampled = done if sampling else 0
+            scale = float(self.getTableRowCount(table) or 0) / done if sampled > 0 else 1.0
+            stats = dict([(profile.name, profile.result(scale)) for profile in profiles])
+            before = self._dataVersionStamp()
+            self._storeColumnStatistics(conn, tablename, version, sampled, stats)
+        except sqlite3.Error, e:
+            self._rollbackSqlite(conn)
+            raise DbError(e)
+        finally:
+            conn.close()
+
+        # storing the statistics writes the file, the statistics of the
+        # other tables valid until then stay valid
+        after = self._dataVersionStamp()
+        for name, stamp in self._statistics_stamps.items():
+            if stamp == before:
+                self._statistics_stamps[name] = after
+        # a write during the scan leaves the new statistics already stale
+        self._statistics_stamps[tablename.lower()] = after if started == before else started
+        self._invalidateMetadata(self.STATISTICS_TABLE)
+        return stats
+
+    def _sampleQueries(self, tablename, columns, fid, sample_rows):
+        """ return the queries reading about sample_rows rows, in blocks of
+            consecutive FIDs: one block at a random place of each slice of
+            the FID range, only the pages of the blocks are read """
+        sql = "SELECT min(%s), max(%s) FROM %s" % (self.quoteId(fid), self.quoteId(fid), self.quoteId(tablename))
+        low, high = self._fetchRows(sql)[0]
+
+        block = self.STATISTICS_SAMPLE_BLOCK
+        count = max(1, sample_rows // block)
+        step = (high - low + 1) // count
+        generator = random.Random(0)
+        sql = "SELECT %s FROM %s WHERE %s >= ? AND %s < ?" % (columns, self.quoteId(tablename), self.quoteId(fid),
+                                                           self.quoteId(fid))
+        queries = []
+        for i in range(count):
+            start = low + i * step + generator.randint(0, max(0, step - block))
+            queries.append((sql, (start, start + block)))
+        return queries
+
+    def _dataVersion(self, table):
+        """ return a value changing when rows of table are added or removed, or
+            written by OGR: the last_change of gpkg_contents and the row count.
+            An UPDATE in SQL changes neither, see _statisticsValid() """
+        schema, tablename = self.getSchemaTableName(table)
+        last_change = None
+        if self._hasTable('gpkg_contents'):
+            sql = "SELECT last_change FROM gpkg_contents WHERE lower(table_name) = lower(%s)" % self.quoteString(tablename)
+            last_change = self._fetchValue(sql)
+        return u"%s/%s" % (last_change, self.getTableRowCount(table))
+
+    def _storeColumnStatistics(self, conn, tablename, version, sampled, stats):
+        conn.execute("BEGIN")
+        conn.execute("""CREATE TABLE IF NOT EXISTS %s (table_name TEXT NOT NULL, column_name TEXT NOT NULL,
+                            data_version TEXT, sampled_rows INTEGER, computed TEXT, statistics TEXT,
+                            PRIMARY KEY (table_name, column_name))""" % self.quoteId(self.STATISTICS_TABLE))
+        conn.execute("DELETE FROM %s WHERE table_name = ?" % self.quoteId(self.STATISTICS_TABLE), (tablename, ))
+        sql = "INSERT INTO %s VALUES (?, ?, ?, ?, strftime('%%Y-%%m-%%dT%%H:%%M:%%SZ', 'now'), ?)" % (
+            self.quoteId(self.STATISTICS_TABLE))
+        conn.executemany(sql, [(tablename, name, version, sampled, json.dumps(values, default=repr))
+                               for name, values in stats.items()])
+        conn.execute("COMMIT")
+
+    def getCachedColumnStatistics(self, table):
+        """ return the statistics stored for table without computing them:
+                (still valid?, computed time, sampled rows (0: all), statistics)
+            None if they have never been computed """
+        if not self._hasTable(self.STATISTICS_TABLE):
+            return None
+        schema, tablename = self.getSchemaTableName(table)
+        sql = "SELECT column_name, data_version, sampled_rows, computed, statistics FROM %s WHERE table_name = %s" % (
+            self.quoteId(self.STATISTICS_TABLE), self.quoteString(tablename))
+        rows = self._fetchRows(sql)
+        if len(rows) == 0:
+            return None
+
+        stats = dict([(row[0], json.loads(row[4])) for row in rows])
+        return self._statisticsValid(tablename, rows[0][1], rows[0][3]), rows[0][3], rows[0][2] or 0, stats
+
+    def _statisticsValid(self, tablename, version, computed):
+        """ return True if the statistics stored with version at computed time
+            (UTC) still describe tablename. The version misses UPDATEs: the
+            statistics computed since the connection was opened are compared
+            with _dataVersionStamp(), older ones are possibly stale as soon as
+            the file has been modified after they were computed """
+        if version != self._dataVersion(tablename):
+            return False
+        stamp = self._statistics_stamps.get(tablename.lower())
+        if stamp is not None:
+            return stamp == self._dataVersionStamp()
+
+        try:
+            computed = calendar.timegm(time.strptime(str(computed), "%Y-%m-%dT%H:%M:%SZ"))
+        except ValueError:
+            return False
+        # (mtime, size) of the file and of its WAL
+        mtimes = self._fileStamp()[0::2]
+        return len(mtimes) > 0 and max(mtimes) <= computed + self.STATISTICS_STORE_DELAY
+
+    def getStatisticsSummary(self):
+        """ return the tables having statistics:
+                (table name, column count, computed time, sampled rows) """
+        if not self._hasTable(self.STATISTICS_TABLE):
+            return []
+        sql = "SELECT table_name, count(*), max(computed), max(sampled_rows) FROM %s GROUP BY table_name ORDER BY table_name" % (
+            self.quoteId(self.STATISTICS_TABLE))
+        return self._fetchRows(sql)
 
     def getTableIndexes(self, table):
-        """ get info about table's indexes """
-#        c = self.connection
-#        sql = str("PRAGMA index_list(%s)" % (str(table[1])))
-#        indexes = c.ExecuteSQL(sql)
-#
-#        for i, idx in enumerate(indexes):
-#            num, name, unique = idx
-#            sql = str("PRAGMA index_info(%s)" % (self.quoteId(name)))
-#            c = c.ExecuteSQL(sql)
-#
-#            idx = [num, name, unique]
-#            cols = []
-#            for seq, cid, cname in c:
-#                cols.append(cid)
-#            idx.append(cols)
-#            indexes[i] = idx
-
-        return []
+        """ get info about table's indexes:
+                (num, name, unique, list of column numbers) """
+        schema, tablename = self.getSchemaTableName(table)
+        return self._cachedMetadata('indexes', tablename, lambda: self._getTableIndexes(tablename))
+
+    def _getTableIndexes(self, tablename):
+        # reuse the bulk index list, read at once for all the tables
+        allindexes = self._cachedMetadata('allindexes', None, self._getAllTableIndexes)
+        if allindexes is not None:
+            return allindexes.get(tablename, [])
+
+        indexes = []
+        for num, name, unique in [row[:3] for row in self._fetchRows("PRAGMA index_list(%s)" % self.quoteId(tablename))]:
+            cols = [row[1] for row in self._fetchRows("PRAGMA index_info(%s)" % self.quoteId(name))]
+            indexes.append((num, name, unique, cols))
+        return indexes
+
+    def _getAllTableIndexes(self):
+        """ return the indexes of every table as a dict table name -> list of
+            indexes like getTableIndexes(), None without table-valued pragmas """
+        sql = """SELECT m.name, il.seq, il.name, il."unique", ii.cid
+                                                FROM sqlite_master AS m JOIN pragma_index_list(m.name) AS il
+                                                JOIN pragma_index_info(il.name) AS ii
+                                                WHERE m.type = 'table'
+                                                ORDER BY m.name, il.seq, ii.seqno"""
+        try:
+            rows = self._fetchRows(sql)
+        except DbError:
+            return None  # SQLite < 3.16
+
+        indexes = {}
+        for tablename, num, name, unique, cid in rows:
+            tableIndexes = indexes.setdefault(tablename, [])
+            if len(tableIndexes) == 0 or tableIndexes[-1][1] != name:
+                tableIndexes.append((num, name, unique, []))
+            tableIndexes[-1][3].append(cid)
+        return indexes
 
     def getTableConstraints(self, table):
         return None
 
     def getTableTriggers(self, table):
-        c = self.connection
         schema, tablename = self.getSchemaTableName(table)
-        sql = str("SELECT name, sql FROM sqlite_master WHERE tbl_name = %s AND type = 'trigger'" % (
-            self.quoteString(tablename)))
-        c = c.ExecuteSQL(sql)
-        return c
+        sql = "SELECT name, sql FROM sqlite_master WHERE tbl_name = ? AND type = 'trigger'"
+        return self._cachedMetadata('triggers', tablename, lambda: self._fetchRows(sql, params=(tablename, )))
 
     def deleteTableTrigger(self, trigger, table=None):
         """ delete trigger """
         sql = str("DROP TRIGGER %s" % self.quoteId(trigger))
-        self.connection.ExecuteSQL(sql)
+        self._writeConnection().ExecuteSQL(sql)
+        self._invalidateMetadata(*([table] if table is not None else []))
 
 
     def getTableExtent(self, table, geom):
-        """ find out table extent """
+        """ find out table extent, from the cheapest source available:
+            the extent stored in gpkg_contents, the R-tree index of the
+            geometry column and at last a scan of the geometries """
         schema, tablename = self.getSchemaTableName(table)
-        c = self.connection
 
-        if self.isRasterTable(table):
-            tablename = tablename.replace('_rasters', '_metadata')
-            geom = 'geometry'
+        extent = self._contentsExtent(tablename)
+        if extent is None and not self.isRasterTable(table):
+            extent = self._rtreeExtent(tablename, geom)
+            if extent is None:
+                extent = self._scanExtent(tablename, geom)
+        return extent
+
+    def updateTableExtent(self, table, geom):
+        """ compute the extent of table and store it in gpkg_contents. The
+            geometries are scanned: the R-tree boxes are float32 rounded
+            outward, only good enough for display """
+        schema, tablename = self.getSchemaTableName(table)
 
-        sql = str("""SELECT Min(MbrMinX(%(geom)s)), Min(MbrMinY(%(geom)s)), Max(MbrMaxX(%(geom)s)), Max(MbrMaxY(%(geom)s))
-                                                FROM %(table)s """ % {'geom': self.quoteId(geom),
-                                                                      'table': self.quoteId(tablename)})
-        c = c.ExecuteSQL(sql)
-        return c
+        extent = self._scanExtent(tablename, geom)
+        if extent is None:
+            return None
+
+        sql = "UPDATE gpkg_contents SET min_x = %r, min_y = %r, max_x = %r, max_y = %r WHERE lower(table_name) = lower(%s)" % (
+            tuple(map(float, extent)) + (self.quoteString(tablename), ))
+        self._executeSql(sql, self._writeConnection())
+        return extent
+
+    def _contentsExtent(self, tablename):
+        if not self._hasTable('gpkg_contents'):
+            return None
+
+        sql = "SELECT min_x, min_y, max_x, max_y FROM gpkg_contents WHERE lower(table_name) = lower(%s)" % self.quoteString(tablename)
+        rows = self._fetchRows(sql)
+        if len(rows) == 0 or None in rows[0]:
+            return None
+        return rows[0]
+
+    def _rtreeExtent(self, tablename, geom):
+        """ read the extent from the root node of the R-tree index """
+        rtree = "rtree_%s_%s" % (tablename, geom)
+        if not self._hasTable(rtree + "_node"):
+            return None
+
+        sql = "SELECT hex(data) FROM %s WHERE nodeno = 1" % self.quoteId(rtree + "_node")
+        data = self._fetchValue(sql)
+        if data is None:
+            return None
+
+        # root node: depth and cell count, then (id, minx, maxx, miny, maxy) cells
+        # with big-endian 32 bit float coordinates, rounded outward by SQLite
+        data = binascii.unhexlify(data)
+        depth, count = struct.unpack_from('>HH', data, 0)
+        if count == 0:
+            return None
+
+        xmin = ymin = float('inf')
+        xmax = ymax = float('-inf')
+        for i in range(count):
+            minx, maxx, miny, maxy = struct.unpack_from('>4f', data, 4 + i * 24 + 8)
+            xmin, ymin = min(xmin, minx), min(ymin, miny)
+            xmax, ymax = max(xmax, maxx), max(ymax, maxy)
+        return (xmin, ymin, xmax, ymax)
+
+    def _scanExtent(self, tablename, geom):
+        """ aggregate the envelopes stored in the geometry blob headers """
+        sql = """SELECT Min(ST_MinX(%(geom)s)), Min(ST_MinY(%(geom)s)), Max(ST_MaxX(%(geom)s)), Max(ST_MaxY(%(geom)s))
+                                                FROM %(table)s WHERE %(geom)s IS NOT NULL AND NOT ST_IsEmpty(%(geom)s)""" % {
+            'geom': self.quoteId(geom), 'table': self.quoteId(tablename)}
+        # OGR evaluates the functions in C, faster than the native ones for a scan
+        rows = self._fetchRows(sql, self._readConnection())
+        if len(rows) == 0 or None in rows[0]:
+            return None
+        return rows[0]
+
+    def getColumnBatches(self, table=None, sql=None, columns=None, batch_size=None):
+        """ read a table or the result of a query as batches of columns: each
+            batch is a dict column name -> values. Numeric columns are NumPy
+            arrays (masked where NULL), geometry columns lists of WKB strings
+            along with "<column>_minx", "_maxx", "_miny" and "_maxy" envelope
+            arrays. columns restricts the columns read, the FID is always kept.
+
+            GDAL's Arrow stream is used when available and no numeric column
+            read may be NULL (its NumPy arrays aren't masked). A batch may then
+            share memory with the next one: copy the arrays to be kept """
+        batch_size = batch_size or self.COLUMN_BATCH_SIZE
+        if numpy is not None and hasattr(ogr.Layer, 'GetArrowStreamAsNumPy'):
+            return self._arrowBatches(table, sql, columns, batch_size)
+        return self._sqliteBatches(table, sql, columns, batch_size)
+
+    def _arrowBatches(self, table, sql, columns, batch_size):
+        conn = self._readConnection()
+        if table is not None:
+            schema, tablename = self.getSchemaTableName(table)
+            lyr = conn.GetLayerByName(str(tablename))
+            if lyr is None:
+                raise DbError(QApplication.translate("DBManagerPlugin", 'Table "{0}" not found').format(tablename))
+        else:
+            lyr = self._executeSql(sql, conn)
+            if lyr is None:
+                return
+
+        defn = lyr.GetLayerDefn()
+        fields = [defn.GetFieldDefn(i) for i in range(defn.GetFieldCount())]
+        if columns is not None:
+            fields = [fld for fld in fields if fld.GetName() in columns]
+        if any(fld.IsNullable() and fld.GetType() in self.NUMERIC_FIELD_TYPES for fld in fields):
+            # NULLs would come as 0, the SQLite batches mask them
+            if table is None:
+                conn.ReleaseResultSet(lyr)
+            for batch in self._sqliteBatches(table, sql, columns, batch_size):
+                yield batch
+            return
+
+        geomNames = [defn.GetGeomFieldDefn(i).GetName() for i in range(defn.GetGeomFieldCount())]
+        if columns is not None:
+            names = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())] + geomNames
+            lyr.SetIgnoredFields([str(name) for name in names if name not in columns])
+            geomNames = [name for name in geomNames if name in columns]
+
+        try:
+            lyr.ResetReading()
+            stream = lyr.GetArrowStreamAsNumPy(options=['MAX_FEATURES_IN_BATCH=%d' % batch_size])
+            for batch in stream:
+                for name in geomNames:
+                    if name in batch:
+                        batch.update(self._envelopeColumns(name, batch[name], 0))
+                yield batch
+        finally:
+            if table is not None:
+                lyr.SetIgnoredFields([])
+            else:
+                conn.ReleaseResultSet(lyr)
+
+    def _sqliteBatches(self, table, sql, columns, batch_size):
+        """ chunked fallback, reading the rows through a native SQLite cursor """
+        if table is not None:
+            schema, tablename = self.getSchemaTableName(table)
+            fid = self.getTableFidColumn(table)
+            names = [fld[1] for fld in self.getTableFields(table)]
+            if columns is not None:
+                names = [name for name in names if name in columns or name == fid]
+            sql = "SELECT %s FROM %s" % (", ".join(map(self.quoteId, names)), self.quoteId(tablename))
+
+        conn = self._openSqlite()
+        try:
+            try:
+                if table is None and columns is not None:
+                    # a column named like the FID of a table is the FID of the result
+                    names = [d[0] for d in conn.execute("SELECT * FROM (%s) LIMIT 0" % sql).description]
+                    fids = self._fidColumnNames(conn)
+                    names = [name for name in names if name in columns or name.lower() in fids]
+                    sql = "SELECT %s FROM (%s)" % (", ".join(map(self.quoteId, names)), sql)
+                cursor = conn.execute(sql)
+            except sqlite3.Error, e:
+                raise DbError(e, sql)
+            if cursor.description is None:
+                return  # statement without result
+            names = [d[0] for d in cursor.description]
+
+            # the kind of a column is decided by its first value not NULL
+            kinds = [None] * len(names)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+
+                batch = {}
+                for i, values in enumerate(zip(*rows)):
+                    if kinds[i] is None:
+                        kinds[i] = self._columnKind(values)
+                    batch.update(self._columnValues(names[i], values, kinds[i]))
+                yield batch
+        finally:
+            conn.close()
+
+    def _fidColumnNames(self, conn):
+        """ return the lower case names of the FID columns of the tables """
+        if not self._hasTable('gpkg_contents'):
+            return set()
+        sql = "SELECT lower(p.name) FROM gpkg_contents c, pragma_table_info(c.table_name) p WHERE p.pk = 1"
+        return set(row[0] for row in conn.execute(sql))
+
+    @staticmethod
+    def _columnKind(values):
+        for value in values:
+            if value is None:
+                continue
+            if isinstance(value, (int, long)):
+                return 'int'
+            if isinstance(value, float):
+                return 'float'
+            if isinstance(value, buffer) and geometry_blob.parseHeader(value) is not None:
+                return 'geom'
+            return 'object'
+        return None
+
+    def _columnValues(self, name, values, kind):
+        """ return the columns built from the values of one column of a batch """
+        if kind == 'geom':
+            wkbs = []
+            for blob in values:
+                header = geometry_blob.parseHeader(blob) if blob is not None else None
+                wkbs.append(str(blob[header[3]:]) if header is not None and not header[2] else None)
+            columns = self._envelopeColumns(name, values, None)
+            columns[name] = wkbs
+            return columns
+
+        if kind == 'int' and any(isinstance(value, float) for value in values):
+            kind = 'float'
+        if kind in ('int', 'float'):
+            nulls = [value is None for value in values]
+            if any(nulls):
+                values = [0 if value is None else value for value in values]
+            try:
+                if numpy is not None:
+                    data = numpy.array(values, dtype=numpy.int64 if kind == 'int' else numpy.float64)
+                    return {name: numpy.ma.array(data, mask=nulls) if any(nulls) else data}
+                if not any(nulls):
+                    return {name: array('l' if kind == 'int' else 'd', values)}
+            except (TypeError, ValueError, OverflowError):
+                pass  # mixed content, SQLite doesn't enforce the column types
+            values = [None if null else value for value, null in zip(values, nulls)]
+        return {name: list(values)}
+
+    def _envelopeColumns(self, name, geometries, offset):
+        """ return the envelope columns of a geometry column, NaN for NULL or
+            empty geometries. offset is the start of the WKB in the values,
+            None for GeoPackage blobs """
+        nan = float('nan')
+        bounds = ([], [], [], [])
+        for geom in geometries:
+            env = None
+            if geom is not None:
+                env = geometry_blob.envelope(geom) if offset is None else geometry_blob.wkbEnvelope(geom, offset)
+            for i, values in enumerate(bounds):
+                values.append(env[i] if env is not None else nan)
+
+        columns = {}
+        for suffix, values in zip(("_minx", "_maxx", "_miny", "_maxy"), bounds):
+            columns[name + suffix] = numpy.array(values) if numpy is not None else array('d', values)
+        return columns
 
     def getViewDefinition(self, view):
         """ returns definition of the view """
@@ -386,28 +1564,26 @@ class GeopackageDBConnector(DBConnector):
         return None
 
     def isVectorTable(self, table):
+        schema, tablename = self.getSchemaTableName(table)
+        return self._cachedMetadata('vector', tablename, lambda: self._isVectorTable(table))
+
+    def _isVectorTable(self, table):
         if self.has_geometry_columns:
             schema, tablename = self.getSchemaTableName(table)
-            sql = "SELECT * FROM geometry_columns WHERE upper(f_table_name) = upper(%s)" % self.quoteString(
-                tablename)
-            c = self.connection.Execute(sql)
-            ret = c.__len__()
+            sql = "SELECT count(*) FROM gpkg_geometry_columns WHERE upper(table_name) = upper(?)"
+            ret = self._fetchValue(sql, params=(tablename, ))
             return ret is not None and ret > 0
         return True
 
     def isRasterTable(self, table):
-        if self.has_geometry_columns and self.has_raster:
-            schema, tablename = self.getSchemaTableName(table)
-            if not tablename.endswith("_rasters"):
-                return False
+        schema, tablename = self.getSchemaTableName(table)
+        return self._cachedMetadata('raster', tablename, lambda: self._isRasterTable(table))
 
-            sql = """SELECT *
-                                        FROM layer_params AS r JOIN geometry_columns AS g
-                                                ON upper(r.table_name||'_metadata') = upper(g.f_table_name)
-                                        WHERE upper(r.table_name) = upper(REPLACE(%s, '_rasters', ''))""" % self.quoteString(
-                tablename)
-            ret = self.connection.ExecuteSQL(sql)
-            return ret is not None and ret.__len__() > 0
+    def _isRasterTable(self, table):
+        if self.has_raster:
+            schema, tablename = self.getSchemaTableName(table)
+            sql = "SELECT count(*) FROM gpkg_tile_matrix_set WHERE upper(table_name) = upper(?)"
+            return self._fetchValue(sql, params=(tablename, )) > 0
 
         return False
 
@@ -426,7 +1602,8 @@ class GeopackageDBConnector(DBConnector):
             sql += ", PRIMARY KEY (%s)" % self.quoteId(pkey)
         sql += ")"
 
-        self.connection.ExecuteSQL(sql)
+        self._writeConnection().ExecuteSQL(sql)
+        self._invalidateMetadata(table)
         return True
 
     def deleteTable(self, table):
@@ -434,12 +1611,16 @@ class GeopackageDBConnector(DBConnector):
         if self.isRasterTable(table):
             return False
 
-        c = self.connection
+        c = self._writeConnection()
         sql = "DROP TABLE %s" % self.quoteId(table)
         c.ExecuteSQL(sql)
+        self._invalidateRowCount(table)
         schema, tablename = self.getSchemaTableName(table)
-        sql = str("DELETE FROM geometry_columns WHERE upper(f_table_name) = upper(%s)" % self.quoteString(tablename))
-        c.ExecuteSQL(sql)
+        if self.has_geometry_columns:
+            for meta in ("gpkg_geometry_columns", "gpkg_ogr_contents", "gpkg_contents"):
+                sql = str("DELETE FROM %s WHERE upper(table_name) = upper(%s)" % (meta, self.quoteString(tablename)))
+                c.ExecuteSQL(sql)
+        self._invalidateMetadata(table)
 
 
     def emptyTable(self, table):
@@ -448,7 +1629,8 @@ class GeopackageDBConnector(DBConnector):
             return False
 
         sql = str("DELETE FROM %s" % self.quoteId(table))
-        self.connection.ExecuteSQL(sql)
+        self._writeConnection().ExecuteSQL(sql)
+        self._invalidateRowCount(table)
 
     def renameTable(self, table, new_table):
         """ rename a table """
@@ -459,16 +1641,19 @@ class GeopackageDBConnector(DBConnector):
         if self.isRasterTable(table):
             return False
 
-        c = self.connection
+        c = self._writeConnection()
 
         sql = str("ALTER TABLE %s RENAME TO %s" % (self.quoteId(table), self.quoteId(new_table)))
         c.ExecuteSQL(sql)
+        self._invalidateRowCount(table)
 
-        # update geometry_columns
+        # update gpkg_geometry_columns
         if self.has_geometry_columns:
-            sql = str("UPDATE geometry_columns SET f_table_name = %s WHERE upper(f_table_name) = upper(%s)" % (
-                self.quoteString(new_table), self.quoteString(tablename)))
-            c.ExecuteSQL(sql)
+            for meta in ("gpkg_contents", "gpkg_geometry_columns", "gpkg_ogr_contents"):
+                sql = str("UPDATE %s SET table_name = %s WHERE upper(table_name) = upper(%s)" % (
+                    meta, self.quoteString(new_table), self.quoteString(tablename)))
+                c.ExecuteSQL(sql)
+        self._invalidateMetadata(table, new_table)
 
 
     def moveTable(self, table, new_table, new_schema=None):
@@ -476,18 +1661,21 @@ class GeopackageDBConnector(DBConnector):
 
     def createView(self, view, query):
         sql = str("CREATE VIEW %s AS %s" % (self.quoteId(view), query))
-        self.connection.ExecuteSQL(sql)
+        self._writeConnection().ExecuteSQL(sql)
+        self._invalidateMetadata(view)
 
     def deleteView(self, view):
-        c = self.connection
+        c = self._writeConnection()
 
         sql = str("DROP VIEW %s" % self.quoteId(view))
         c.ExecuteSQL(sql)
 
-        # update geometry_columns
+        # update gpkg_geometry_columns
         if self.has_geometry_columns:
-            sql = str("DELETE FROM geometry_columns WHERE f_table_name = %s" % self.quoteString(view))
-            c.ExecuteSQL(sql)
+            for meta in ("gpkg_geometry_columns", "gpkg_contents"):
+                sql = str("DELETE FROM %s WHERE table_name = %s" % (meta, self.quoteString(view)))
+                c.ExecuteSQL(sql)
+        self._invalidateMetadata(view)
 
     def renameView(self, view, new_name):
         """ rename view """
@@ -497,7 +1685,7 @@ class GeopackageDBConnector(DBConnector):
         self.createView(view, query)
         # get type info about the view
         sql = str("PRAGMA table_info(%s)" % self.quoteString(view))
-        c = self.connection.ExecuteSQL(sql )
+        c = self._readConnection().ExecuteSQL(sql )
         geom_col = None
         for r in c:        
             if r[2].upper() in ('POINT', 'LINESTRING', 'POLYGON',
@@ -509,7 +1697,7 @@ class GeopackageDBConnector(DBConnector):
 
         # get geometry type and srid
         sql = str("SELECT geometrytype(%s), srid(%s) FROM %s LIMIT 1" % (self.quoteId(geom_col), self.quoteId(geom_col), self.quoteId(view)))
-        r = self.connection.ExecuteSQL(sql )
+        r = self._readConnection().ExecuteSQL(sql )
         if r is None:
             return
 
@@ -530,17 +1718,348 @@ class GeopackageDBConnector(DBConnector):
         
         sql = str("""INSERT INTO geometry_columns (f_table_name, f_geometry_column, geometry_type, coord_dimension, srid, spatial_index_enabled)
                                         VALUES (%s, %s, %s, %s, %s, 0)""" % (self.quoteId(view), self.quoteId(geom_col), wkbType, len(gdim), gsrid))
-        self.connection.ExecuteSQL(sql)
+        self._writeConnection().ExecuteSQL(sql)
+        self._invalidateMetadata(view)
 
-    def runVacuum(self):
-        """ run vacuum on the db """
-        self.connection.ExecuteSQL("VACUUM")
+    def runVacuum(self, progress=None):
+        """ run vacuum on the db, on its own connection so it can be run from
+            a worker thread. progress(done, total) is called while VACUUM runs,
+            with total = 0 as VACUUM doesn't tell how far it is, and cancels it
+            by returning True. Return False if it has been cancelled. """
+        return self._vacuum("VACUUM", progress)
+
+    def enableIncrementalVacuum(self, progress=None):
+        """ switch the db to auto_vacuum=INCREMENTAL, this runs a full VACUUM """
+        return self._vacuum("PRAGMA auto_vacuum = INCREMENTAL", progress)
+
+    def getAutoVacuum(self):
+        """ return the auto_vacuum mode: 0 = none, 1 = full, 2 = incremental """
+        return self._fetchValue("PRAGMA auto_vacuum")
+
+    def _vacuum(self, pragma, progress=None):
+        conn = self._openSqlite()
+        state = {'cancelled': False}
+
+        def handler():
+            state['cancelled'] = progress(0, 0) is True
+            return 1 if state['cancelled'] else 0
+
+        try:
+            if progress is not None:
+                conn.set_progress_handler(handler, 100000)
+            if pragma != "VACUUM":
+                conn.execute(pragma)
+            conn.execute("VACUUM")
+        except sqlite3.Error, e:
+            if state['cancelled']:
+                return False  # VACUUM is atomic, nothing has been changed
+            raise DbError(e, pragma)
+        finally:
+            conn.close()
+        return True
+
+    def runIncrementalVacuum(self, pages=1000, progress=None):
+        """ reclaim the free pages of a db in auto_vacuum=INCREMENTAL mode,
+            'pages' pages per transaction. progress(done, total) is called after
+            each slice and stops the vacuum by returning True.
+            Return False if it has been cancelled. """
+        conn = self._openSqlite()
+        try:
+            total = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            done = 0
+            while done < total:
+                # the pragma reclaims one page per returned row
+                conn.execute("PRAGMA incremental_vacuum(%d)" % pages).fetchall()
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if total - free == done:
+                    break  # nothing reclaimed, not in incremental mode
+                done = total - free
+                if progress is not None and progress(done, total) is True:
+                    return False
+        except sqlite3.Error, e:
+            raise DbError(e, "PRAGMA incremental_vacuum")
+        finally:
+            conn.close()
+        return True
+
+
+    def importData(self, source, table, layer=None, append=False, geom_column='geom', index_columns=(),
+                   defer_indexes=True, batch_size=None, open_options=None, progress=None):
+        """ copy the features of an OGR source into table. source is a file
+            name (CSV included, see CSV_OPEN_OPTIONS) or an OGR layer, layer
+            picks a layer of a multi-layer source. The table is created unless
+            append is set. Features are written in transactions of batch_size,
+            the R-tree and the indexes of index_columns are built at the end,
+            as are the existing indexes of the table if defer_indexes is set.
+            progress(done, total) is called after each transaction and stops
+            the import by returning True, committed features are kept.
+            Return the number of features imported """
+        batch_size = batch_size or self.IMPORT_BATCH_SIZE
+        src, srcLyr = self._openImportSource(source, layer, open_options)
+
+        schema, tablename = self.getSchemaTableName(table)
+        exists = self._hasTable(tablename)
+        if exists and not append:
+            raise DbError(QApplication.translate("DBManagerPlugin", 'Table "{0}" already exists').format(tablename))
+        if not exists and append:
+            raise DbError(QApplication.translate("DBManagerPlugin", 'Table "{0}" not found').format(tablename))
+
+        # indexes slow down every insert, drop them and build them again at the end
+        indexes, rtrees = [], []
+        if exists and defer_indexes:
+            indexes, rtrees = self._dropIndexes(tablename)
+        elif not exists and srcLyr.GetGeomType() != ogr.wkbNone:
+            rtrees = [geom_column]
+        # when appending, the indexes already there are kept
+        indexes += ["CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (self.quoteId("idx_%s_%s" % (tablename, column)),
+                                                                 self.quoteId(tablename), self.quoteId(column))
+                    for column in index_columns]
+
+        # OGR keeps the state of the R-tree of its layers, reopen the writer
+        self._closeWriter()
+        ds = self._writeConnection()
+        pragmas = self._relaxDurability(ds)
+        try:
+            if exists:
+                dstLyr = ds.GetLayerByName(str(tablename))
+            else:
+                dstLyr = self._createImportLayer(ds, srcLyr, tablename, geom_column)
+            done = self._copyFeatures(ds, srcLyr, dstLyr, batch_size, progress)
+            dstLyr.SyncToDisk()
+        except Exception:
+            # also after a failure, the dropped indexes must come back, but
+            # the error of the import is the one to report
+            error = sys.exc_info()
+            try:
+                self._finishImport(ds, pragmas, table, indexes, rtrees)
+            except Exception:
+                pass
+            raise error[0], error[1], error[2]
+        self._finishImport(ds, pragmas, table, indexes, rtrees)
+        return done
+
+    def _finishImport(self, ds, pragmas, table, indexes, rtrees):
+        """ restore the pragmas and build the indexes after an import. Every
+            step is tried, the first error is raised at the end """
+        errors = []
+
+        def attempt(func, *args):
+            try:
+                func(*args)
+            except Exception:
+                errors.append(sys.exc_info())
+
+        for pragma, value in pragmas:
+            attempt(self._fetchRows, "PRAGMA %s = %s" % (pragma, value), ds)
+        self._closeWriter()
+        self._invalidateRowCount(table)
+
+        for sql in indexes:
+            attempt(self._executeSql, sql, self._writeConnection())
+        self._invalidateMetadata(table)
+        for column in rtrees:
+            attempt(self.createSpatialIndex, table, column)
+        if len(errors) > 0:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def _openImportSource(self, source, layer, open_options):
+        """ return (datasource, layer) to read an import from """
+        if isinstance(source, ogr.Layer):
+            return None, source
+
+        if open_options is None and source.lower().endswith('.csv'):
+            open_options = self.CSV_OPEN_OPTIONS
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        src = gdal.OpenEx(source, gdal.OF_VECTOR, open_options=open_options or [])
+        if src is None:
+            raise DbError(gdal.GetLastErrorMsg())
+
+        srcLyr = src.GetLayerByName(str(layer)) if layer is not None else src.GetLayer(0)
+        if srcLyr is None:
+            raise DbError(QApplication.translate("DBManagerPlugin", 'Layer "{0}" not found').format(layer))
+        return src, srcLyr
+
+    def _createImportLayer(self, ds, srcLyr, tablename, geom_column):
+        options = ['SPATIAL_INDEX=NO']  # built at the end by createSpatialIndex()
+        if srcLyr.GetGeomType() != ogr.wkbNone:
+            options.append('GEOMETRY_NAME=%s' % geom_column)
+        dstLyr = ds.CreateLayer(str(tablename), srcLyr.GetSpatialRef(), srcLyr.GetGeomType(), options)
+        if dstLyr is None:
+            raise DbError(gdal.GetLastErrorMsg())
+
+        defn = srcLyr.GetLayerDefn()
+        for i in range(defn.GetFieldCount()):
+            dstLyr.CreateField(defn.GetFieldDefn(i))
+        return dstLyr
+
+    def _copyFeatures(self, ds, srcLyr, dstLyr, batch_size, progress):
+        """ copy the features of srcLyr, batch_size per transaction """
+        defn, dstDefn = srcLyr.GetLayerDefn(), dstLyr.GetLayerDefn()
+        # source field -> destination field, by name (-1: dropped)
+        fieldMap = [dstDefn.GetFieldIndex(defn.GetFieldDefn(i).GetName()) for i in range(defn.GetFieldCount())]
+        total = max(srcLyr.GetFeatureCount(force=False), 0)  # -1 if unknown
+
+        done = 0
+        srcLyr.ResetReading()
+        ds.StartTransaction()
+        try:
+            feat = srcLyr.GetNextFeature()
+            while feat is not None:
+                out = ogr.Feature(dstDefn)
+                out.SetFromWithMap(feat, 1, fieldMap)
+                if dstLyr.CreateFeature(out) != 0:
+                    raise DbError(gdal.GetLastErrorMsg())
+                done += 1
+
+                if done % batch_size == 0:
+                    ds.CommitTransaction()
+                    if progress is not None and progress(done, total) is True:
+                        return done
+                    ds.StartTransaction()
+                feat = srcLyr.GetNextFeature()
+        except Exception:
+            ds.RollbackTransaction()
+            raise
+
+        ds.CommitTransaction()
+        if progress is not None:
+            progress(done, total)
+        return done
+
+    def _dropIndexes(self, tablename):
+        """ drop the attribute and R-tree indexes of tablename, return the
+            statements creating the attribute indexes and the indexed columns.
+            UNIQUE indexes are kept, without them duplicates would be imported
+            and the index couldn't be built again """
+        sql = "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND lower(tbl_name) = lower(%s)" % (
+            self.quoteString(tablename))
+        unique = set(row[1] for row in self._fetchRows("PRAGMA index_list(%s)" % self.quoteId(tablename)) if row[2])
+        rows = [(name, sql) for name, sql in self._fetchRows(sql) if name not in unique]
+
+        rtrees = []
+        if self.has_geometry_columns:
+            sql = "SELECT column_name FROM gpkg_geometry_columns WHERE lower(table_name) = lower(%s)" % self.quoteString(tablename)
+            rtrees = [row[0] for row in self._fetchRows(sql) if self.hasSpatialIndex(tablename, row[0])]
+
+        for name, sql in rows:
+            self._executeSql("DROP INDEX %s" % self.quoteId(name), self._writeConnection())
+        for column in rtrees:
+            self.deleteSpatialIndex(tablename, column)
+        return [sql for name, sql in rows], rtrees
+
+    def _relaxDurability(self, ds):
+        """ skip the fsyncs and keep the rollback journal in memory for a bulk
+            load on ds. Return the (pragma, value) pairs to restore """
+        pragmas = []
+        for pragma, value in (("synchronous", "OFF"), ("journal_mode", "MEMORY")):
+            current = self._fetchValue("PRAGMA %s" % pragma, ds)
+            if current is None or unicode(current).lower() in (value.lower(), "wal"):
+                continue  # WAL can't be left while other connections are open
+            self._fetchRows("PRAGMA %s = %s" % (pragma, value), ds)
+            pragmas.append((pragma, current))
+        return pragmas
+
+    def exportData(self, dest, table=None, sql=None, format=None, split_rows=None, batch_size=None,
+                   options=None, progress=None):
+        """ stream a table or the result of a query to dest, written by the OGR
+            driver of format (see EXPORT_FORMATS, by default guessed from the
+            file extension). With split_rows, a file is written every split_rows
+            rows, named like dest with a _0001, _0002... suffix. progress(done,
+            total) is called every batch_size rows and stops the export by
+            returning True, the files written are then removed.
+            Return the list of files written """
+        batch_size = batch_size or self.EXPORT_BATCH_SIZE
+        base, ext = os.path.splitext(dest)
+        format = format or ext.lower().lstrip('.')
+        if format not in self.EXPORT_FORMATS:
+            raise DbError(QApplication.translate("DBManagerPlugin", 'Unknown export format "{0}"').format(format))
+        driverName, defaultOptions = self.EXPORT_FORMATS[format]
+        driver = ogr.GetDriverByName(driverName)
+        if driver is None:
+            raise DbError(QApplication.translate("DBManagerPlugin", 'The {0} driver is not available').format(driverName))
+        options = defaultOptions + (options or [])
+        if driverName == 'Parquet':
+            options = options + ['ROW_GROUP_SIZE=%d' % batch_size]
+
+        conn = self._readConnection()
+        if table is not None:
+            schema, tablename = self.getSchemaTableName(table)
+            srcLyr = conn.GetLayerByName(str(tablename))
+            if srcLyr is None:
+                raise DbError(QApplication.translate("DBManagerPlugin", 'Table "{0}" not found').format(tablename))
+            total = self.getTableRowCount(table) or 0
+        else:
+            srcLyr = self._executeSql(sql, conn)
+            if srcLyr is None:
+                return []
+            total = 0  # unknown
+
+        files = []
+        dst = None
+        try:
+            srcLyr.ResetReading()
+            done = 0
+            feat = srcLyr.GetNextFeature()
+            while feat is not None:
+                if dst is None:
+                    path = dest if not split_rows else "%s_%04d%s" % (base, len(files) + 1, ext)
+                    dst, dstLyr = self._createExportLayer(driver, path, srcLyr, options)
+                    files.append(path)
+
+                out = ogr.Feature(dstLyr.GetLayerDefn())
+                out.SetFrom(feat)
+                if dstLyr.CreateFeature(out) != 0:
+                    raise DbError(gdal.GetLastErrorMsg())
+                done += 1
+
+                if split_rows and done % split_rows == 0:
+                    dst = dstLyr = None  # closes the file
+                if done % batch_size == 0 and progress is not None and progress(done, total) is True:
+                    dst = dstLyr = None
+                    for path in files:
+                        driver.DeleteDataSource(path)
+                    return []
+                feat = srcLyr.GetNextFeature()
+
+            # no rows, the file still gets the layer and its fields
+            if len(files) == 0:
+                path = dest if not split_rows else "%s_%04d%s" % (base, 1, ext)
+                dst, dstLyr = self._createExportLayer(driver, path, srcLyr, options)
+                files.append(path)
+        finally:
+            dst = dstLyr = None
+            if table is None:
+                conn.ReleaseResultSet(srcLyr)
+
+        if progress is not None:
+            progress(done, total)
+        return files
+
+    def _createExportLayer(self, driver, path, srcLyr, options):
+        """ create the output file of an export, return (datasource, layer) """
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        dst = driver.CreateDataSource(path)
+        if dst is None:
+            raise DbError(gdal.GetLastErrorMsg())
+
+        name = os.path.splitext(os.path.basename(path))[0]
+        dstLyr = dst.CreateLayer(str(name), srcLyr.GetSpatialRef(), srcLyr.GetGeomType(), options)
+        if dstLyr is None:
+            raise DbError(gdal.GetLastErrorMsg())
+
+        defn = srcLyr.GetLayerDefn()
+        for i in range(defn.GetFieldCount()):
+            dstLyr.CreateField(defn.GetFieldDefn(i))
+        return dst, dstLyr
 
 
     def addTableColumn(self, table, field_def):
         """ add a column to table """
         sql = str("ALTER TABLE %s ADD %s" % (self.quoteId(table), field_def))
-        self.connection.ExecuteSQL(sql)
+        self._writeConnection().ExecuteSQL(sql)
+        self._invalidateMetadata(table)
 
     def deleteTableColumn(self, table, column):
         """ delete column from a table """
@@ -550,7 +2069,8 @@ class GeopackageDBConnector(DBConnector):
         # delete geometry column correctly
         schema, tablename = self.getSchemaTableName(table)
         sql = str("SELECT DiscardGeometryColumn(%s, %s)" % (self.quoteString(tablename), self.quoteString(column)))
-        self.connection.ExecuteSQL(sql)
+        self._writeConnection().ExecuteSQL(sql)
+        self._invalidateMetadata(table)
 
     def updateTableColumn(self, table, column, new_name, new_data_type=None, new_not_null=None, new_default=None):
         return False  # column editing not supported
@@ -572,18 +2092,25 @@ class GeopackageDBConnector(DBConnector):
         return False  # column editing not supported
 
     def isGeometryColumn(self, table, column):
-        c = self.connection
+        return column.lower() in self.getTableGeometryColumns(table)
+
+    def getTableGeometryColumns(self, table):
+        """ return the lower case names of the geometry columns of table """
         schema, tablename = self.getSchemaTableName(table)
-        sql = str("SELECT count(*) > 0 FROM geometry_columns WHERE upper(f_table_name) = upper(%s) AND upper(f_geometry_column) = upper(%s)" % (
-            self.quoteString(tablename), self.quoteString(column)))
-        c = c.ExecuteSQL(sql)
-        return c[0] == 't'
+        return self._cachedMetadata('geomcolumns', tablename, lambda: self._getTableGeometryColumns(tablename))
+
+    def _getTableGeometryColumns(self, tablename):
+        if not self.has_geometry_columns:
+            return []
+        sql = "SELECT lower(column_name) FROM gpkg_geometry_columns WHERE upper(table_name) = upper(?)"
+        return [row[0] for row in self._fetchRows(sql, params=(tablename, ))]
 
     def addGeometryColumn(self, table, geom_column='geometry', geom_type='POINT', srid=-1, dim=2):
         schema, tablename = self.getSchemaTableName(table)
         sql = str("SELECT AddGeometryColumn(%s, %s, %d, %s, %s)" % (
             self.quoteString(tablename), self.quoteString(geom_column), srid, self.quoteString(geom_type), dim))
-        self.connection.ExecuteSQL(sql)
+        self._writeConnection().ExecuteSQL(sql)
+        self._invalidateMetadata(table)
 
     def deleteGeometryColumn(self, table, geom_column):
         return self.deleteTableColumn(table, geom_column)
@@ -601,53 +2128,183 @@ class GeopackageDBConnector(DBConnector):
     def addTablePrimaryKey(self, table, column):
         """ add a primery key (with one column) to a table """
         sql = str("ALTER TABLE %s ADD PRIMARY KEY (%s)" % (self.quoteId(table), self.quoteId(column)))
-        self.connection.ExecuteSQL(sql)
+        self._writeConnection().ExecuteSQL(sql)
+        self._invalidateMetadata(table)
+
 
+    def indexAdvisor(self):
+        """ return the advisor recording the queries run on this database """
+        if self._indexAdvisor is None:
+            from .index_advisor import IndexAdvisor
+            self._indexAdvisor = IndexAdvisor(self)
+        return self._indexAdvisor
 
     def createTableIndex(self, table, name, column, unique=False):
-        """ create index on one column using default options """
+        """ create index on one column, or on a list of columns, using default options """
+        columns = column if isinstance(column, (list, tuple)) else [column]
         unique_str = "UNIQUE" if unique else ""
-        sql = str("CREATE %s INDEX %s ON %s (%s)" % (
-            unique_str, self.quoteId(name), self.quoteId(table), self.quoteId(column)))
-        self.conncetion.ExecuteSQL(str(sql))
+        sql = u"CREATE %s INDEX %s ON %s (%s)" % (
+            unique_str, self.quoteId(name), self.quoteId(table), ", ".join(map(self.quoteId, columns)))
+        self._executeSql(sql, self._writeConnection())
+        self._invalidateMetadata(table)
 
     def deleteTableIndex(self, table, name):
         schema, tablename = self.getSchemaTableName(table)
         sql = str("DROP INDEX %s" % self.quoteId((schema, name)))
-        self.connection.ExecuteSQL(sql)
+        self._writeConnection().ExecuteSQL(sql)
+        self._invalidateMetadata(table)
 
     def createSpatialIndex(self, table, geom_column='geometry'):
+        """ create the R-tree index of a geometry column (gpkg_rtree_index
+            extension). The envelopes are read from the geometry blobs and
+            inserted in Sort-Tile-Recursive order in a single transaction """
         if self.isRasterTable(table):
             return False
 
         schema, tablename = self.getSchemaTableName(table)
-        sql = str("SELECT CreateSpatialIndex(%s, %s)" % (self.quoteString(tablename), self.quoteString(geom_column)))
-        self.connection.ExecuteSQL(sql)
+        fid = self.getTableFidColumn(table)
+        if fid is None or self.hasSpatialIndex(table, geom_column):
+            return False
+
+        ids, minx, maxx, miny, maxy = [], array('d'), array('d'), array('d'), array('d')
+        conn = self._openSqlite()
+        try:
+            sql = "SELECT %s, %s FROM %s WHERE %s IS NOT NULL" % (
+                self.quoteId(fid), self.quoteId(geom_column), self.quoteId(tablename), self.quoteId(geom_column))
+            for row in conn.execute(sql):
+                env = geometry_blob.envelope(row[1])
+                if env is not None:
+                    ids.append(row[0])
+                    minx.append(env[0])
+                    maxx.append(env[1])
+                    miny.append(env[2])
+                    maxy.append(env[3])
+
+            # boxes sharing a node are inserted one after the other, the tree
+            # pages stay in the cache and the nodes end up well packed
+            order = geometry_blob.strOrder(minx, maxx, miny, maxy)
+            boxes = ((ids[i], minx[i], maxx[i], miny[i], maxy[i]) for i in order)
+
+            rtree = self.quoteId("rtree_%s_%s" % (tablename, geom_column))
+            conn.execute("BEGIN")
+            conn.execute("CREATE VIRTUAL TABLE %s USING rtree(id, minx, maxx, miny, maxy)" % rtree)
+            conn.executemany("INSERT INTO %s VALUES (?, ?, ?, ?, ?)" % rtree, boxes)
+            for sql in self._spatialIndexTriggers(tablename, geom_column, fid):
+                conn.execute(sql)
+
+            conn.execute("""CREATE TABLE IF NOT EXISTS gpkg_extensions (table_name TEXT, column_name TEXT,
+                                extension_name TEXT NOT NULL, definition TEXT NOT NULL, scope TEXT NOT NULL,
+                                CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))""")
+            conn.execute("""INSERT OR REPLACE INTO gpkg_extensions VALUES (?, ?, 'gpkg_rtree_index',
+                                'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')""",
+                         (tablename, geom_column))
+            conn.execute("COMMIT")
+        except sqlite3.Error, e:
+            self._rollbackSqlite(conn)
+            raise DbError(e)
+        finally:
+            conn.close()
+
+        self._invalidateMetadata(table)
+        return True
+
+    def _spatialIndexTriggers(self, tablename, geom_column, fid):
+        """ return the triggers keeping the R-tree index up to date """
+        names = {'t': self.quoteId(tablename), 'c': self.quoteId(geom_column), 'i': self.quoteId(fid),
+                 'r': self.quoteId("rtree_%s_%s" % (tablename, geom_column))}
+        for suffix in ('insert', 'update1', 'update2', 'update3', 'update4', 'delete'):
+            names[suffix] = self.quoteId("rtree_%s_%s_%s" % (tablename, geom_column, suffix))
+
+        insert = """INSERT OR REPLACE INTO %(r)s VALUES (NEW.%(i)s,
+                        ST_MinX(NEW.%(c)s), ST_MaxX(NEW.%(c)s), ST_MinY(NEW.%(c)s), ST_MaxY(NEW.%(c)s));""" % names
+        return [
+            """CREATE TRIGGER %(insert)s AFTER INSERT ON %(t)s
+                   WHEN (NEW.%(c)s NOT NULL AND NOT ST_IsEmpty(NEW.%(c)s))
+               BEGIN %%s END""" % names % insert,
+            """CREATE TRIGGER %(update1)s AFTER UPDATE OF %(c)s ON %(t)s
+                   WHEN OLD.%(i)s = NEW.%(i)s AND (NEW.%(c)s NOTNULL AND NOT ST_IsEmpty(NEW.%(c)s))
+               BEGIN %%s END""" % names % insert,
+            """CREATE TRIGGER %(update2)s AFTER UPDATE OF %(c)s ON %(t)s
+                   WHEN OLD.%(i)s = NEW.%(i)s AND (NEW.%(c)s ISNULL OR ST_IsEmpty(NEW.%(c)s))
+               BEGIN DELETE FROM %(r)s WHERE id = OLD.%(i)s; END""" % names,
+            """CREATE TRIGGER %(update3)s AFTER UPDATE ON %(t)s
+                   WHEN OLD.%(i)s != NEW.%(i)s AND (NEW.%(c)s NOTNULL AND NOT ST_IsEmpty(NEW.%(c)s))
+               BEGIN DELETE FROM %(r)s WHERE id = OLD.%(i)s; %%s END""" % names % insert,
+            """CREATE TRIGGER %(update4)s AFTER UPDATE ON %(t)s
+                   WHEN OLD.%(i)s != NEW.%(i)s AND (NEW.%(c)s ISNULL OR ST_IsEmpty(NEW.%(c)s))
+               BEGIN DELETE FROM %(r)s WHERE id IN (OLD.%(i)s, NEW.%(i)s); END""" % names,
+            """CREATE TRIGGER %(delete)s AFTER DELETE ON %(t)s
+                   WHEN OLD.%(c)s NOT NULL
+               BEGIN DELETE FROM %(r)s WHERE id = OLD.%(i)s; END""" % names,
+        ]
 
     def deleteSpatialIndex(self, table, geom_column='geometry'):
+        """ drop the R-tree index of a geometry column with its triggers """
         if self.isRasterTable(table):
             return False
 
         schema, tablename = self.getSchemaTableName(table)
+        rtree = "rtree_%s_%s" % (tablename, geom_column)
+
+        conn = self._openSqlite()
         try:
-            sql = str("SELECT DiscardSpatialIndex(%s, %s)" % (self.quoteString(tablename), self.quoteString(geom_column)))
-            self.connection.ExecuteSQL(sql)
-        except DbError:
-            sql = str("SELECT DeleteSpatialIndex(%s, %s)" % (self.quoteString(tablename), self.quoteString(geom_column)))
-            self.connection.ExecuteSQL(sql)
-            # delete the index table
-            idx_table_name = "idx_%s_%s" % (tablename, geom_column)
-            self.deleteTable(idx_table_name)
+            conn.execute("BEGIN")
+            # GDAL may also have created update5 to update7
+            for suffix in ('insert', 'update1', 'update2', 'update3', 'update4', 'update5', 'update6', 'update7', 'delete'):
+                conn.execute("DROP TRIGGER IF EXISTS %s" % self.quoteId("%s_%s" % (rtree, suffix)))
+            conn.execute("DROP TABLE IF EXISTS %s" % self.quoteId(rtree))
+            if self._hasTable('gpkg_extensions'):
+                conn.execute("""DELETE FROM gpkg_extensions WHERE lower(table_name) = lower(?)
+                                    AND lower(column_name) = lower(?) AND extension_name = 'gpkg_rtree_index'""",
+                             (tablename, geom_column))
+            conn.execute("COMMIT")
+        except sqlite3.Error, e:
+            self._rollbackSqlite(conn)
+            raise DbError(e)
+        finally:
+            conn.close()
+
+        self._invalidateMetadata(table)
+        return True
 
     def hasSpatialIndex(self, table, geom_column='geometry'):
         if not self.has_geometry_columns or self.isRasterTable(table):
             return False
-        c = self.connection()
         schema, tablename = self.getSchemaTableName(table)
-        sql = str("SELECT spatial_index_enabled FROM geometry_columns WHERE upper(f_table_name) = upper(%s) AND upper(f_geometry_column) = upper(%s)" % (
-            self.quoteString(tablename), self.quoteString(geom_column)))
-        row = c.ExecuteSQL(sql)
-        return row is not None and row[0] == 1
+        indexed = self._cachedMetadata('spatialindex', tablename, lambda: self._getSpatialIndexes(tablename))
+        return geom_column.lower() in indexed
+
+    def _getSpatialIndexes(self, tablename):
+        """ return the geometry columns of tablename having an R-tree index """
+        if not self._hasTable('gpkg_extensions'):
+            return []
+        sql = """SELECT column_name FROM gpkg_extensions
+                                                WHERE lower(table_name) = lower(%s) AND extension_name = 'gpkg_rtree_index'""" % self.quoteString(tablename)
+        return [row[0].lower() for row in self._fetchRows(sql)
+                if row[0] is not None and self._hasTable("rtree_%s_%s" % (tablename, row[0]))]
+
+    def checkFilterExpression(self, table, expression):
+        """ raise DbError if expression isn't a valid condition on table. The
+            statement is prepared by SQLite but no row is read (LIMIT 0) """
+        sql = u"SELECT 1 FROM %s WHERE %s LIMIT 0" % (self.quoteId(table), expression)
+        self._fetchRows(sql, self._readConnection())
+
+    def getSpatialFilter(self, table, geom_column, rect):
+        """ return the condition selecting the rows of table whose bbox intersects
+            rect = (xmin, ymin, xmax, ymax), a lookup in the R-tree index if
+            there's one, else a test of the envelopes in the geometry blobs """
+        schema, tablename = self.getSchemaTableName(table)
+        xmin, ymin, xmax, ymax = map(float, rect)
+
+        fid = self.getTableFidColumn(table)
+        if fid is not None and self.hasSpatialIndex(table, geom_column):
+            rtree = self.quoteId("rtree_%s_%s" % (tablename, geom_column))
+            return "%s IN (SELECT id FROM %s WHERE minx <= %r AND maxx >= %r AND miny <= %r AND maxy >= %r)" % (
+                self.quoteId(fid), rtree, xmax, xmin, ymax, ymin)
+
+        geom = self.quoteId(geom_column)
+        return "ST_MinX(%s) <= %r AND ST_MaxX(%s) >= %r AND ST_MinY(%s) <= %r AND ST_MaxY(%s) >= %r" % (
+            geom, xmax, geom, xmin, geom, ymax, geom, ymin)
 
     def execution_error_types(self):
         return True
@@ -691,16 +2348,20 @@ class GeopackageDBConnector(DBConnector):
         from .sql_dictionary import getSqlDictionary
 
         sql_dict = getSqlDictionary()
+        sql_dict["identifier"] = list(self._cachedMetadata('dictionary', None, self._getIdentifiers))
+        return sql_dict
+
+    def _getIdentifiers(self):
+        """ return table and field names, without reading any feature """
+        allfields = self.getAllTableFields()
 
         items = []
         for tbl in self.getTables():
             items.append(tbl[1])  # table name
 
-            for fld in self.getTableFields(tbl[0]):
+            for fld in allfields.get(tbl[1], []):
                 items.append(fld[1])  # field name
-
-        sql_dict["identifier"] = items
-        return sql_dict
+        return items
 
     def getQueryBuilderDictionary(self):
         from .sql_dictionary import getQueryBuilderDictionary
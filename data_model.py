@@ -20,37 +20,71 @@ email                   : cch@sourcepole.ch
  ***************************************************************************/
 """
 
-from ..data_model import TableDataModel, SqlResultModel
+import binascii
+from bisect import bisect_right
+
+from PyQt4.QtCore import Qt, QModelIndex, QThread, QTime, pyqtSignal
+from PyQt4.QtGui import QApplication, QProgressDialog, QMessageBox, QFont, QAction, QFileDialog
+
+from ..data_model import BaseTableModel, TableDataModel, SqlResultModel
+from ..plugin import DbError
+
+from . import geometry_blob
+
 
 class SLTableDataModel(TableDataModel):
+    # rows fetched per page, the model never holds more than one page
+    PAGE_SIZE = 256
+    # every ANCHOR_STEP rows the last seen FID is remembered, so that a page
+    # can be fetched with "fid > anchor" instead of a large OFFSET
+    ANCHOR_STEP = 128
+
     def __init__(self, table, parent=None):
         TableDataModel.__init__(self, table, parent)
 
-        fields_txt = ", ".join(self.fields)
-        table_txt = self.db.quoteId((self.table.schemaName(), self.table.name))
-
-        # run query and get results
-        sql = str("SELECT %s FROM %s" % (str(fields_txt), str(table_txt)))
-        c = self.db.connection
-        self.resdata = c.ExecuteSQL(sql)
-        data = []
-
-        for feat in self.resdata:
-            count = feat.GetFieldCount() + 1
-            fields = ()
-            for i in range(count):
-                if i == 0:
-                    fields += (feat.GetFID(), )
-                elif i == 1:
-                    fields += (None, )
-                else:
-                    fields += (feat.GetField(i-1), )
-            data.append(fields)
-            
-        self.resdata = data
-        self.fetchedFrom = 0
-        self.fetchedCount = len(self.resdata)
+        self.table_txt = self.db.quoteId((self.table.schemaName(), self.table.name))
+        self.fidColumn = self.db.getTableFidColumn((self.table.schemaName(), self.table.name))
 
+        # geometry columns are fetched as hex text, OGR would build a geometry
+        # per row, and only their blob header and WKB structure are decoded
+        self._geomColumns = self.db.getTableGeometryColumns((self.table.schemaName(), self.table.name))
+        self.geomFields = [i for i, fld in enumerate(self.table.fields()) if self._isGeometryField(fld)]
+        self.fieldNames = map(lambda x: x.name, self.table.fields())
+
+        self.resdata = []
+        self.fetchedCount = self.PAGE_SIZE
+        self.fetchedFrom = -self.fetchedCount - 1  # so the first call to getData will exec fetchMoreData(0)
+
+        # row number -> sort key of the row before it (None: start of the table),
+        # the FID or (sort value, FID) when sorted on a column
+        self._anchors = {0: None}
+        self._anchorRows = [0]
+
+        # used while the table row count is unknown, see canFetchMore()
+        self._loadedRows = 0
+        self._exhausted = False
+
+        # bbox filter (xmin, ymin, xmax, ymax), see setFilterRect()
+        self.geomColumn = getattr(self.table, 'geomColumn', None)
+        self.filterRect = None
+        self._canvas = None
+
+        # SQL condition and sort column, see setFilterExpression() and sort()
+        self.filterExpression = None
+        self.sortColumn = None
+        self.sortOrder = Qt.AscendingOrder
+        self.sortIndex = None  # (index backed?, query plan)
+
+    def _isGeometryField(self, field):
+        # registered in gpkg_geometry_columns, whatever its type (curves...),
+        # or a column of a view declared with a geometry type
+        if field.name.lower() in self._geomColumns:
+            return True
+        dataType = field.dataType.upper()
+        if dataType[:5] == "MULTI": dataType = dataType[5:]
+        if dataType[-3:] == "25D": dataType = dataType[:-3]
+        if dataType[-10:] == "COLLECTION": dataType = dataType[:-10]
+        return dataType in ["POINT", "LINESTRING", "POLYGON", "GEOMETRY"]
 
     def _sanitizeTableField(self, field):
         # get fields, ignore geometry columns
@@ -62,9 +96,525 @@ class SLTableDataModel(TableDataModel):
 #            return u'GeometryType(%s)' % self.db.quoteId(field.name)
         return self.db.quoteId(field.name)
 
+    def _pageQuery(self, row_start, count):
+        """ build the query returning 'count' rows starting at row 'row_start' """
+        fields = []
+        for i, fld in enumerate(self.fields):
+            if i in self.geomFields:
+                fld = "hex(%s) AS %s" % (fld, self.db.quoteId("geomhex_%d" % i))
+            fields.append(fld)
+        if self.sortColumn is not None:
+            # the sort value as SQL literal, to build the keyset conditions
+            fields.append("quote(%s) AS %s" % (self.fields[self.sortColumn], self.db.quoteId("sortkey")))
+        fields_txt = ", ".join(fields)
+
+        conditions = self._filterConditions()
+        if self.fidColumn is None:
+            # no FID to page on (e.g. a view), fall back to OFFSET paging
+            sql = u"SELECT %s FROM %s %s%sLIMIT %d OFFSET %d" % (
+                fields_txt, self.table_txt, self._where(conditions), self._orderBy(), count, row_start)
+            return sql.encode('utf-8')
+
+        # start from the nearest known anchor before the requested row
+        anchor_row = self._anchorRows[bisect_right(self._anchorRows, row_start) - 1]
+        anchor = self._anchors[anchor_row]
+        if anchor is not None:
+            conditions.append(self._keysetCondition(anchor))
+
+        sql = u"SELECT %s FROM %s %s%sLIMIT %d OFFSET %d" % (
+            fields_txt, self.table_txt, self._where(conditions), self._orderBy(), count, row_start - anchor_row)
+        return sql.encode('utf-8')
+
+    def _orderBy(self):
+        direction = " DESC" if self.sortOrder == Qt.DescendingOrder else ""
+        terms = []
+        if self.sortColumn is not None:
+            terms.append(self.fields[self.sortColumn] + direction)
+        if self.fidColumn is not None:
+            terms.append(self.db.quoteId(self.fidColumn) + direction)
+        return "ORDER BY %s " % ", ".join(terms) if len(terms) > 0 else ""
+
+    def _keysetCondition(self, anchor):
+        """ return the condition selecting the rows following the anchor, a FID
+            or (sort value literal, FID), in the sort order. SQLite puts NULLs
+            first in ascending order, last in descending order """
+        fid = self.db.quoteId(self.fidColumn)
+        op = "<" if self.sortOrder == Qt.DescendingOrder else ">"
+        if self.sortColumn is None:
+            return "%s %s %d" % (fid, op, anchor)
+
+        col = self.fields[self.sortColumn]
+        value, anchor_fid = anchor
+        if value == "NULL":
+            if op == "<":
+                return "%s IS NULL AND %s < %d" % (col, fid, anchor_fid)
+            return "(%s IS NULL AND %s > %d) OR %s IS NOT NULL" % (col, fid, anchor_fid, col)
+
+        # "col >= value" first, so that an index on col gives the range
+        cond = "%s %s= %s AND (%s %s %s OR %s %s %d)" % (col, op, value, col, op, value, fid, op, anchor_fid)
+        if op == "<":
+            cond = "(%s) OR %s IS NULL" % (cond, col)
+        return cond
+
+    def _filterConditions(self):
+        """ return the conditions the shown rows must satisfy """
+        conditions = []
+        if self.filterRect is not None:
+            table = (self.table.schemaName(), self.table.name)
+            conditions.append(self.db.getSpatialFilter(table, self.geomColumn, self.filterRect))
+        if self.filterExpression:
+            conditions.append(self.filterExpression)
+        return conditions
+
+    def _isFiltered(self):
+        return self.filterRect is not None or bool(self.filterExpression)
+
+    def _where(self, conditions):
+        if len(conditions) == 0:
+            return ""
+        return u"WHERE %s " % u" AND ".join([u"(%s)" % cond for cond in conditions])
+
+    def setFilterExpression(self, expression):
+        """ only show the rows matching a SQL expression, e.g. "population > 1000".
+            None or "" shows all the rows again. Raise DbError if the
+            expression is invalid, the filter is then left unchanged """
+        expression = unicode(expression).strip() if expression else None
+        if expression == self.filterExpression:
+            return
+
+        if expression is not None:
+            self.db.checkFilterExpression((self.table.schemaName(), self.table.name), expression)
+
+        self.beginResetModel()
+        self.filterExpression = expression
+        self._resetRows()
+        self.endResetModel()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """ sort the rows in SQLite, column -1 goes back to the FID order """
+        if column < 0 or column in self.geomFields:
+            column = None
+        self.beginResetModel()
+        self.sortColumn = column
+        self.sortOrder = order
+        self._resetRows()
+        self.sortIndex = self._checkSortIndex() if column is not None else None
+        self.endResetModel()
+
+    def _checkSortIndex(self):
+        """ tell whether SQLite sorts the rows through an index, from the plan
+            of the first page query. Return (index backed?, plan) """
+        try:
+            plan = self.db.getQueryPlan(self._pageQuery(0, self.fetchedCount))
+        except DbError:
+            return None
+        return not any(["TEMP B-TREE" in detail for detail in plan]), plan
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and section == self.sortColumn and self.sortIndex is not None:
+            indexed, plan = self.sortIndex
+            if role == Qt.ToolTipRole:
+                if indexed:
+                    text = QApplication.translate("DBManagerPlugin", "Sorted through an index")
+                else:
+                    text = QApplication.translate("DBManagerPlugin",
+                                                  "No index for this sort: each page sorts every matching row")
+                return u"%s\n\n%s" % (text, u"\n".join(plan))
+            if role == Qt.FontRole:
+                font = QFont()
+                font.setBold(True)
+                font.setItalic(not indexed)
+                return font
+        return TableDataModel.headerData(self, section, orientation, role)
+
+    def setFilterRect(self, rect):
+        """ only show the rows whose bbox intersects rect, a QgsRectangle or
+            (xmin, ymin, xmax, ymax). None shows all the rows again """
+        if self.geomColumn is None:
+            return
+        if rect is not None and hasattr(rect, 'xMinimum'):
+            rect = (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum())
+        if rect == self.filterRect:
+            return
+
+        self.beginResetModel()
+        self.filterRect = rect
+        self._resetRows()
+        self.endResetModel()
+
+    def followCanvas(self, canvas):
+        """ keep the bbox filter on the extent of a map canvas, None to stop """
+        if self._canvas is not None:
+            self._canvas.extentsChanged.disconnect(self._canvasExtentChanged)
+        self._canvas = canvas
+        if canvas is None:
+            self.setFilterRect(None)
+            return
+        canvas.extentsChanged.connect(self._canvasExtentChanged)
+        self._canvasExtentChanged()
+
+    def _canvasExtentChanged(self):
+        from qgis.core import QgsCoordinateReferenceSystem, QgsCoordinateTransform
+
+        extent = self._canvas.extent()
+        srid = getattr(self.table, 'srid', None)
+        if srid is not None and srid > 0:
+            canvasCrs = self._canvas.mapSettings().destinationCrs()
+            tableCrs = QgsCoordinateReferenceSystem(int(srid), QgsCoordinateReferenceSystem.EpsgCrsId)
+            if tableCrs.isValid() and tableCrs != canvasCrs:
+                extent = QgsCoordinateTransform(canvasCrs, tableCrs).transformBoundingBox(extent)
+        self.setFilterRect(extent)
+
+    def _resetRows(self):
+        """ forget the fetched rows and anchors, the filters changed """
+        self.resdata = []
+        self.fetchedFrom = -self.fetchedCount - 1
+        self._anchors = {0: None}
+        self._anchorRows = [0]
+        self._loadedRows = 0
+        self._exhausted = False
+        # filtered rows aren't counted, a count would scan the table on each
+        # filter change or canvas pan: they are discovered page by page
+
+    def _fetchRows(self, row_start, count):
+        """ fetch a page of rows, returns a list of tuples """
+        conn = self.db._readConnection()
+        lyr = conn.ExecuteSQL(self._pageQuery(row_start, count))
+        if lyr is None:
+            return []
+
+        try:
+            defn = lyr.GetLayerDefn()
+            lyrFid = lyr.GetFIDColumn()
+
+            # map the table fields to the result layer
+            getters = []
+            for i, name in enumerate(self.fieldNames):
+                if i in self.geomFields:
+                    name = "geomhex_%d" % i
+                if name == self.fidColumn and lyrFid:
+                    getters.append(-1)
+                else:
+                    idx = defn.GetFieldIndex(str(name))
+                    getters.append(idx if idx >= 0 else None)
+
+            sortKey = defn.GetFieldIndex("sortkey") if self.sortColumn is not None else -1
+            # without a FID column in the result, the fid is an ordinary field
+            fidKey = -1
+            if self.fidColumn is not None and not lyrFid:
+                fidKey = defn.GetFieldIndex(str(self.fidColumn))
+
+            data = []
+            keys = []
+            feat = lyr.GetNextFeature()
+            while feat is not None:
+                fields = ()
+                for idx in getters:
+                    if idx is None:
+                        fields += (None, )
+                    elif idx < 0:
+                        fields += (feat.GetFID(), )
+                    else:
+                        fields += (feat.GetField(idx) if feat.IsFieldSet(idx) else None, )
+                data.append(fields)
+                fid = feat.GetField(fidKey) if fidKey >= 0 else feat.GetFID()
+                keys.append((feat.GetField(sortKey), fid) if sortKey >= 0 else fid)
+                feat = lyr.GetNextFeature()
+        finally:
+            conn.ReleaseResultSet(lyr)
+
+        if len(self.geomFields) > 0 and len(data) > 0:
+            data = self._summarizeGeometries(data)
+
+        if self.fidColumn is not None:
+            self._addAnchors(row_start, keys)
+        return data
+
+    def _summarizeGeometries(self, data):
+        """ replace the hex geometry blobs of a page by type, vertex count and bbox """
+        columns = map(list, zip(*data))
+        for i in self.geomFields:
+            blobs = [binascii.unhexlify(h) if h else None for h in columns[i]]
+            columns[i] = geometry_blob.summarize(blobs)
+        return zip(*columns)
+
+    def _addAnchors(self, row_start, keys):
+        """ remember the sort keys at the anchor grid positions of a fetched page """
+        first = (row_start // self.ANCHOR_STEP + 1) * self.ANCHOR_STEP
+        for row in range(first, row_start + len(keys) + 1, self.ANCHOR_STEP):
+            if row in self._anchors:
+                continue
+            self._anchors[row] = keys[row - row_start - 1]
+            self._anchorRows.insert(bisect_right(self._anchorRows, row), row)
+
+    def getData(self, row, col):
+        if row < self.fetchedFrom or row >= self.fetchedFrom + len(self.resdata):
+            # center the page on the requested row, aligned to the anchor grid
+            start = max(0, row - self.fetchedCount / 2)
+            self.fetchMoreData(start - start % self.ANCHOR_STEP)
+
+        row -= self.fetchedFrom
+        if row >= len(self.resdata):
+            return None  # rows deleted meanwhile
+        return self.resdata[row][col]
+
+    def fetchMoreData(self, row_start):
+        self.resdata = self._fetchRows(row_start, self.fetchedCount)
+        self.fetchedFrom = row_start
+
     def rowCount(self, index=None):
-        return self.fetchedCount
+        if self._isFiltered():
+            return self._loadedRows
+        if self.table.rowCount is not None:
+            return TableDataModel.rowCount(self, index)
+        return self._loadedRows
+
+    def _rowCountKnown(self):
+        if self._isFiltered():
+            return False
+        return self.table.rowCount is not None
+
+    def canFetchMore(self, index=QModelIndex()):
+        # without a row count the rows are discovered page by page
+        return not self._rowCountKnown() and not self._exhausted
+
+    def fetchMore(self, index=QModelIndex()):
+        rows = self._fetchRows(self._loadedRows, self.fetchedCount)
+        if len(rows) < self.fetchedCount:
+            self._exhausted = True
+        if len(rows) == 0:
+            return
+
+        # keep the new rows as current page, they are the ones to be shown
+        self.beginInsertRows(QModelIndex(), self._loadedRows, self._loadedRows + len(rows) - 1)
+        self.resdata = rows
+        self.fetchedFrom = self._loadedRows
+        self._loadedRows += len(rows)
+        self.endInsertRows()
+
+
+class SLSqlQueryThread(QThread):
+    """ run a query and send its rows in batches """
+    headerFetched = pyqtSignal(object)
+    rowsFetched = pyqtSignal(object)
+
+    # threads still running, a QThread must not be destroyed before its end
+    running = set()
+
+    def __init__(self, db, sql, batch_size):
+        QThread.__init__(self)
+        self.db = db
+        self.sql = sql
+        self.batch_size = batch_size
+        self.error = None
+        self.cached = False
+        self.changes = None  # rows changed by a statement without result
+        self.native = False  # run by SQLite alone, cancel() interrupts it
+        self._cancelled = False
+        self._native = None
+
+        SLSqlQueryThread.running.add(self)
+        self.finished.connect(lambda: SLSqlQueryThread.running.discard(self))
+
+    def cancel(self):
+        """ stop the query, interrupting the statement if SQLite runs it """
+        self._cancelled = True
+        native = self._native
+        if native is not None:
+            native.interrupt()
+
+    def isCancelled(self):
+        return self._cancelled
+
+    def run(self):
+        cached = self.db.getCachedResult(self.sql)
+        if cached is not None:
+            self.cached = True
+            header, rows = cached
+            self.headerFetched.emit(header)
+            for start in range(0, len(rows), self.batch_size):
+                self.rowsFetched.emit(rows[start:start + self.batch_size])
+            # a reused result is still a run of the query for the index advisor
+            try:
+                self.db.indexAdvisor().record(self.sql)
+            finally:
+                self.db._releaseReadConnection()
+            return
+
+        # read before running the query, a write meanwhile invalidates the result
+        version = self.db._dataVersionStamp()
+        status = {}
+        self._native = self.db._nativeConnection()
+        result = self.db._iterQuery(self.sql, self._native, status)
+        try:
+            if self._cancelled:
+                return  # cancelled before the statement could be interrupted
+            header = result.next()
+            self.native = status.get('native', False)
+            self.headerFetched.emit(header)
+
+            # the result is kept for the next run unless it is too large
+            kept = []
+            rows = []
+            for row in result:
+                if self._cancelled:
+                    break
+                rows.append(row)
+                if len(rows) >= self.batch_size:
+                    self.rowsFetched.emit(rows)
+                    if kept is not None:
+                        kept.extend(rows)
+                        if len(kept) > self.db.RESULT_CACHE_ROWS:
+                            kept = None
+                    rows = []
+            if len(rows) > 0 and not self._cancelled:
+                self.rowsFetched.emit(rows)
+                if kept is not None:
+                    kept.extend(rows)
+            if not self._cancelled:
+                if kept is not None and len(header) > 0:
+                    self.db.cacheResult(self.sql, version, header, kept)
+                # the advisor proposes indexes for the tables scanned again and again
+                self.db.indexAdvisor().record(self.sql)
+            self.changes = status.get('changes')
+        except DbError, e:
+            if not self._cancelled:  # else SQLite reports the interruption
+                self.error = e
+        finally:
+            self._native = None
+            # finalize the statement if the query has been cancelled
+            result.close()
+            self.db._releaseReadConnection()
 
 
 class SLSqlResultModel(SqlResultModel):
-    pass
+    """ run the query in a worker thread, rows are added as they arrive """
+    BATCH_SIZE = 500
+
+    def __init__(self, db, sql, parent=None):
+        self.database = db
+        self.db = db.connector
+        self.sql = unicode(sql)
+        self._secs = 0
+        self._affectedRows = 0
+        BaseTableModel.__init__(self, None, None, parent)
+
+        self._time = QTime()
+        self._time.start()
+
+        self._thread = SLSqlQueryThread(self.db, self.sql, self.BATCH_SIZE)
+        self._thread.headerFetched.connect(self._headerFetched)
+        self._thread.rowsFetched.connect(self._rowsFetched)
+        self._thread.finished.connect(self._queryFinished)
+
+        # OGR can't interrupt a statement, Cancel only stops it between two rows
+        self._interruptible = self.db._runsNatively(self.sql)
+
+        # shown only if the query doesn't return immediately
+        self._progress = QProgressDialog(self._progressLabel(), QApplication.translate("DBManagerPlugin", "Cancel"),
+                                         0, 0, parent)
+        self._progress.setWindowModality(Qt.NonModal)
+        self._progress.setMinimumDuration(500)
+        self._progress.canceled.connect(self.cancel)
+
+        addExportResultAction(parent)
+        self._thread.start()
+
+    def cancel(self):
+        """ stop the query, the rows fetched so far are kept """
+        self._thread.cancel()
+
+    def isRunning(self):
+        return self._thread.isRunning()
+
+    def isCancelled(self):
+        return self._thread.isCancelled()
+
+    def isCached(self):
+        """ return True if the rows are those of a previous run of the query """
+        return self._thread.cached
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.ToolTipRole and orientation == Qt.Horizontal and self.isCached():
+            return QApplication.translate("DBManagerPlugin", "Result of a previous run, the data hasn't changed since")
+        return SqlResultModel.headerData(self, section, orientation, role)
+
+    def exportData(self, dest, format=None, split_rows=None, parent=None):
+        """ run the query again, streaming its result to a file """
+        return self.database.exportData(dest, None, self.sql, format, split_rows, parent)
+
+    def _progressLabel(self):
+        if self._thread.cached:
+            label = QApplication.translate("DBManagerPlugin", "Reusing the previous result... {0} rows")
+        elif self._interruptible:
+            label = QApplication.translate("DBManagerPlugin", "Running query... {0} rows")
+        else:
+            label = QApplication.translate("DBManagerPlugin",
+                                           "Running query through OGR, Cancel takes effect once rows arrive... {0} rows")
+        return label.format(self._affectedRows)
+
+    def _headerFetched(self, header):
+        self._interruptible = self._thread.native
+        self._progress.setLabelText(self._progressLabel())
+        self.beginResetModel()
+        self._header = header
+        self.endResetModel()
+
+    def _rowsFetched(self, rows):
+        if self._thread.isCancelled():
+            return
+        self.beginInsertRows(QModelIndex(), len(self.resdata), len(self.resdata) + len(rows) - 1)
+        self.resdata.extend(rows)
+        self._affectedRows = len(self.resdata)
+        self.endInsertRows()
+        self._progress.setLabelText(self._progressLabel())
+
+    def _queryFinished(self):
+        self._secs = self._time.elapsed() / 1000.0
+        self._progress.reset()
+        self._progress.deleteLater()
+
+        if self._thread.changes is not None:
+            self._affectedRows = self._thread.changes
+            self.database.refresh()  # the statement may have changed the schema
+        self._showResult()
+
+        error = self._thread.error
+        if error is not None:
+            QMessageBox.warning(QApplication.activeWindow(), QApplication.translate("DBManagerPlugin", "Query error"),
+                                unicode(error))
+
+    def _showResult(self):
+        """ the SQL window shows the row count and the time when the model is
+            created, update them now that the query is over """
+        label = getattr(self.parent(), 'lblResult', None)
+        if label is not None:
+            text = QApplication.translate("DBManagerPlugin", "{0} rows, {1:.1f} seconds").format(
+                self._affectedRows, self._secs)
+            if self.isCached():
+                text += QApplication.translate("DBManagerPlugin", " (cached)")
+            label.setText(text)
+
+
+def addExportResultAction(window):
+    """ add "Export Result..." to the context menu of the result view of a SQL
+        window, once: the window keeps its view from one query to the next """
+    view = getattr(window, 'viewResult', None)
+    if view is None or getattr(window, 'exportResultAction', None) is not None:
+        return
+
+    def exportResult():
+        model = view.model()
+        if not isinstance(model, SLSqlResultModel):
+            return
+        dest = QFileDialog.getSaveFileName(window, QApplication.translate("DBManagerPlugin", "Export result"), "",
+                                           QApplication.translate("DBManagerPlugin",
+                                                                  "FlatGeobuf (*.fgb);;GeoParquet (*.parquet);;CSV (*.csv)"))
+        if dest:
+            model.exportData(unicode(dest), parent=window)
+
+    action = QAction(QApplication.translate("DBManagerPlugin", "Export Result..."), view)
+    action.triggered.connect(exportResult)
+    view.addAction(action)
+    view.setContextMenuPolicy(Qt.ActionsContextMenu)
+    window.exportResultAction = action
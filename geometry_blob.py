@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import struct
+
+# GeoPackage geometry blobs are read without building OGR geometries:
+#   'GP', version, flags, srs_id, [envelope], WKB
+
+_MAGIC = struct.Struct('<2sBB')
+_INT = (struct.Struct('>i'), struct.Struct('<i'))
+_UINT = (struct.Struct('>I'), struct.Struct('<I'))
+
+# envelope indicator -> number of doubles
+_ENVELOPE_SIZE = {0: 0, 1: 4, 2: 6, 3: 6, 4: 8}
+
+# WKB base types
+_POINT, _LINESTRING, _POLYGON = 1, 2, 3
+_CIRCULARSTRING, _TRIANGLE = 8, 17
+
+TYPE_NAMES = {
+    1: "POINT", 2: "LINESTRING", 3: "POLYGON", 4: "MULTIPOINT", 5: "MULTILINESTRING",
+    6: "MULTIPOLYGON", 7: "GEOMETRYCOLLECTION", 8: "CIRCULARSTRING", 9: "COMPOUNDCURVE",
+    10: "CURVEPOLYGON", 11: "MULTICURVE", 12: "MULTISURFACE", 13: "CURVE", 14: "SURFACE",
+    15: "POLYHEDRALSURFACE", 16: "TIN", 17: "TRIANGLE"
+}
+
+
+def parseHeader(blob):
+    """ return (srs_id, envelope, empty, wkb offset) of a GeoPackage blob,
+        envelope being (minx, maxx, miny, maxy) or None if not stored.
+        Return None if blob is not a GeoPackage geometry """
+    if blob is None or len(blob) < 8:
+        return None
+    magic, version, flags = _MAGIC.unpack_from(blob, 0)
+    if magic != b'GP':
+        return None
+
+    little = flags & 1
+    srs_id = _INT[little].unpack_from(blob, 4)[0]
+    indicator = (flags >> 1) & 7
+    count = _ENVELOPE_SIZE.get(indicator, 0)
+
+    envelope = None
+    if count > 0:
+        values = struct.unpack_from('%s%dd' % ('<' if little else '>', count), blob, 8)
+        envelope = values[:4]
+    return srs_id, envelope, bool(flags & 0x10), 8 + count * 8
+
+
+def wkbType(blob, offset):
+    """ return (base type, has z, has m) of the WKB starting at offset """
+    little = ord(blob[offset:offset + 1])
+    code = _UINT[little].unpack_from(blob, offset + 1)[0]
+    return _splitType(code)
+
+
+def _splitType(code):
+    # ISO codes (1000 = Z, 2000 = M, 3000 = ZM) and the old 2.5D flag
+    z = bool(code & 0x80000000)
+    m = bool(code & 0x40000000)
+    code &= 0x0fffffff
+    dims, base = divmod(code, 1000)
+    return base, z or dims in (1, 3), m or dims in (2, 3)
+
+
+def _walk(blob, offset, bounds):
+    """ walk one WKB geometry, extending bounds = [minx, maxx, miny, maxy]
+        with its coordinates. Return the offset following the geometry """
+    little = ord(blob[offset:offset + 1])
+    uint = _UINT[little]
+    base, z, m = _splitType(uint.unpack_from(blob, offset + 1)[0])
+    dims = 2 + z + m
+    offset += 5
+
+    def points(offset, count):
+        if count > 0:
+            coords = struct.unpack_from('%s%dd' % ('<' if little else '>', count * dims), blob, offset)
+            xs, ys = coords[0::dims], coords[1::dims]
+            bounds[0] = min(bounds[0], min(xs))
+            bounds[1] = max(bounds[1], max(xs))
+            bounds[2] = min(bounds[2], min(ys))
+            bounds[3] = max(bounds[3], max(ys))
+        return offset + count * dims * 8
+
+    if base == _POINT:
+        coords = struct.unpack_from('%s2d' % ('<' if little else '>'), blob, offset)
+        if coords[0] == coords[0]:  # empty points are stored as NaN
+            points(offset, 1)
+        return offset + dims * 8
+
+    count = uint.unpack_from(blob, offset)[0]
+    offset += 4
+    if base in (_LINESTRING, _CIRCULARSTRING):
+        return points(offset, count)
+
+    if base in (_POLYGON, _TRIANGLE):
+        for i in range(count):
+            npoints = uint.unpack_from(blob, offset)[0]
+            offset = points(offset + 4, npoints)
+        return offset
+
+    # collections, compound curves, curve polygons, surfaces...
+    for i in range(count):
+        offset = _walk(blob, offset, bounds)
+    return offset
+
+
+def _count(blob, offset):
+    """ count the vertices of one WKB geometry without reading them.
+        Return (offset following the geometry, vertex count) """
+    little = ord(blob[offset:offset + 1])
+    uint = _UINT[little]
+    base, z, m = _splitType(uint.unpack_from(blob, offset + 1)[0])
+    size = (2 + z + m) * 8
+    offset += 5
+
+    if base == _POINT:
+        return offset + size, 1
+
+    count = uint.unpack_from(blob, offset)[0]
+    offset += 4
+    if base in (_LINESTRING, _CIRCULARSTRING):
+        return offset + count * size, count
+
+    total = 0
+    for i in range(count):
+        if base in (_POLYGON, _TRIANGLE):
+            npoints = uint.unpack_from(blob, offset)[0]
+            offset += 4 + npoints * size
+        else:
+            offset, npoints = _count(blob, offset)
+        total += npoints
+    return offset, total
+
+
+def wkbEnvelope(wkb, offset=0):
+    """ return (minx, maxx, miny, maxy) of a WKB geometry, None if empty """
+    bounds = [float('inf'), float('-inf'), float('inf'), float('-inf')]
+    try:
+        _walk(wkb, offset, bounds)
+    except (struct.error, TypeError):
+        return None
+    if bounds[0] > bounds[1]:
+        return None
+    return tuple(bounds)
+
+
+def envelope(blob):
+    """ return (minx, maxx, miny, maxy) of a GeoPackage geometry blob, read
+        from the header if stored there, None for empty or invalid geometries """
+    header = parseHeader(blob)
+    if header is None:
+        return None
+    srs_id, env, empty, offset = header
+    if empty:
+        return None
+    if env is not None:
+        return env
+    return wkbEnvelope(blob, offset)
+
+
+def strOrder(minx, maxx, miny, maxy, node_capacity=160):
+    """ return the positions of the boxes in Sort-Tile-Recursive order: boxes
+        ending up in the same R-tree node are next to each other """
+    n = len(minx)
+    if n == 0:
+        return []
+
+    slices = max(1, int((float(n) / node_capacity) ** 0.5 + 0.999999))
+    slice_size = node_capacity * int(float(n) / (node_capacity * slices) + 0.999999)
+
+    order = sorted(range(n), key=lambda i: minx[i] + maxx[i])
+    result = []
+    for start in range(0, n, slice_size):
+        part = order[start:start + slice_size]
+        part.sort(key=lambda i: miny[i] + maxy[i])
+        result.extend(part)
+    return result
+
+
+def summary(blob):
+    """ return (type name, vertex count, envelope) of a GeoPackage geometry
+        blob, None if it isn't one. The envelope is None for empty geometries """
+    header = parseHeader(blob)
+    if header is None:
+        return None
+    srs_id, env, empty, offset = header
+
+    try:
+        base, z, m = wkbType(blob, offset)
+        name = TYPE_NAMES.get(base, "GEOMETRY") + (" ZM" if z and m else " Z" if z else " M" if m else "")
+        if empty:
+            return name, 0, None
+        vertices = _count(blob, offset)[1]
+    except (struct.error, TypeError):
+        return None
+
+    if env is None:
+        env = envelope(blob)
+    return name, vertices, env
+
+
+def summarize(blobs):
+    """ return a display text for each blob of a list, e.g.
+            POLYGON, 5 vertices [0 0, 10 10] """
+    texts = []
+    for blob in blobs:
+        info = summary(blob) if blob is not None else None
+        if info is None:
+            texts.append(None)
+            continue
+
+        name, vertices, env = info
+        if env is None:
+            texts.append(u"%s EMPTY" % name)
+        elif vertices == 1:
+            texts.append(u"%s [%.10g %.10g]" % (name, env[0], env[2]))
+        else:
+            texts.append(u"%s, %d vertices [%.10g %.10g, %.10g %.10g]" % (
+                name, vertices, env[0], env[2], env[1], env[3]))
+    return texts
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import math
+import re
+import threading
+
+from ..plugin import DbError
+
+# SQL tokens: quoted identifiers, strings, numbers, words and operators
+_TOKEN = re.compile(r"""\s*(?:("(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])|('(?:[^']|'')*')|(\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)|"""
+                    r"""([A-Za-z_][\w$]*)|(<=|>=|<>|!=|==|\|\||\S))""")
+
+_KEYWORDS = set("""select from where join on using inner left right outer cross natural as and or not null is in like glob
+    between escape order group by having limit offset asc desc collate case when then else end exists distinct all
+    union intersect except with cast""".split())
+_CLAUSES = set(["select", "from", "join", "on", "where", "group", "order", "having", "limit", "union", "intersect", "except"])
+_EQUALITY = set(["=", "==", "is", "in"])
+_RANGE = set(["<", ">", "<=", ">=", "between", "like", "glob"])
+
+# a full scan of a table in the EXPLAIN QUERY PLAN details
+_SCAN = re.compile(r'^SCAN (?:TABLE )?(\S+)(?: AS (\S+))?(?: USING (?:COVERING )?INDEX)?')
+
+
+def tokenize(sql):
+    """ return the tokens of sql as (kind, text): 'ident' (unquoted), 'word',
+        'string', 'number' or 'op' """
+    tokens = []
+    pos = 0
+    while pos < len(sql):
+        match = _TOKEN.match(sql, pos)
+        if match is None or match.end() == pos:
+            break
+        pos = match.end()
+        quoted, string, number, word, op = match.groups()
+        if quoted is not None:
+            tokens.append(('ident', quoted[1:-1].replace('""', '"')))
+        elif string is not None:
+            tokens.append(('string', string))
+        elif number is not None:
+            tokens.append(('number', number))
+        elif word is not None:
+            tokens.append(('word', word))
+        elif op is not None:
+            tokens.append(('op', op))
+    return tokens
+
+
+def columnUsage(sql):
+    """ return the aliases of the tables of a query, alias -> table name, and
+        its column references (qualifier or None, column, usage), usage being
+        'eq' or 'range' in WHERE and ON conditions, 'order' in ORDER BY """
+    tokens = tokenize(sql)
+    aliases = {}
+    refs = []
+    clause = None
+    for i, (kind, text) in enumerate(tokens):
+        lower = text.lower() if kind == 'word' else None
+        if lower in _CLAUSES:
+            clause = lower
+            continue
+        if kind not in ('word', 'ident') or lower in _KEYWORDS:
+            continue
+
+        prev = tokens[i - 1] if i > 0 else (None, None)
+        after = tokens[i + 1] if i + 1 < len(tokens) else (None, None)
+        if after == ('op', '('):
+            continue  # function call
+
+        if clause in ('from', 'join') and (prev[0] is None or prev[1].lower() in ('from', 'join') or prev == ('op', ',')):
+            # table name, maybe followed by an alias
+            alias = text
+            nxt = i + 1
+            if nxt < len(tokens) and tokens[nxt][1].lower() == 'as':
+                nxt += 1
+            if nxt < len(tokens) and tokens[nxt][0] in ('word', 'ident') and tokens[nxt][1].lower() not in _KEYWORDS:
+                alias = tokens[nxt][1]
+            aliases[alias.lower()] = text
+            aliases[text.lower()] = text
+            continue
+
+        if clause not in ('where', 'on', 'order') or after == ('op', '.'):
+            continue
+        qualifier = tokens[i - 2][1] if prev == ('op', '.') and i >= 2 else None
+
+        if clause == 'order':
+            usage = 'order'
+        else:
+            near = set([prev[1].lower() if prev[1] else None, after[1].lower() if after[1] else None])
+            if qualifier is not None and i >= 3:
+                near.add(tokens[i - 3][1].lower())
+            usage = 'eq' if near & _EQUALITY else 'range' if near & _RANGE else None
+            if usage is None:
+                continue
+        refs.append((qualifier, text, usage))
+    return aliases, refs
+
+
+class IndexAdvisor(object):
+    """ record the queries run on a database and propose indexes for the
+        tables they repeatedly scan in full """
+    # scans of a table with the same columns before an index is proposed
+    MIN_SCANS = 2
+
+    def __init__(self, connector):
+        self.connector = connector
+        # (table, columns) -> [scan count, last query]
+        self._scans = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql):
+        """ check the plan of a query, remember the columns of its full scans """
+        first = tokenize(sql)[:1]
+        if len(first) == 0 or first[0][1].lower() not in ('select', 'with'):
+            return  # not a query
+        try:
+            plan = self.connector.getQueryPlan(sql)
+        except DbError:
+            return
+
+        aliases, refs = columnUsage(sql)
+        for detail in plan:
+            match = _SCAN.match(detail)
+            if match is None or ' USING ' in detail:
+                continue  # index search or index scan
+            name = match.group(2) or match.group(1)
+            table = aliases.get(name.lower(), match.group(1))
+            columns = self._indexColumns(table, name, aliases, refs)
+            if len(columns) == 0:
+                continue
+            with self._lock:
+                entry = self._scans.setdefault((table, tuple(columns)), [0, None])
+                entry[0] += 1
+                entry[1] = sql
+
+    def _indexColumns(self, table, alias, aliases, refs):
+        """ return the columns of an index for the references to table:
+            equality columns first, then a range or the ORDER BY column """
+        fields = [fld[1] for fld in self.connector.getTableFields(table)]
+        byName = dict([(name.lower(), name) for name in fields])
+
+        eq, rng, order = [], [], []
+        for qualifier, column, usage in refs:
+            if qualifier is not None and aliases.get(qualifier.lower(), qualifier).lower() != table.lower():
+                continue
+            name = byName.get(column.lower())
+            if name is None:
+                continue
+            {'eq': eq, 'range': rng, 'order': order}[usage].append(name)
+
+        columns = []
+        for name in eq + rng[:1] + order[:1]:
+            if name not in columns:
+                columns.append(name)
+        return columns
+
+    def suggestions(self):
+        """ return the proposed indexes, the most useful first:
+                (table, columns, full scans, rows read per scan, rows read with the index) """
+        with self._lock:
+            scans = [(key, entry[0]) for key, entry in self._scans.items() if entry[0] >= self.MIN_SCANS]
+
+        ret = []
+        for (table, columns), count in scans:
+            if self._hasIndex(table, columns):
+                continue
+            rows = self.connector.getTableRowCount(table) or 0
+            ret.append((table, list(columns), count, rows, self._estimateRows(table, columns, rows)))
+        return sorted(ret, key=lambda s: -(s[2] * (s[3] - s[4])))
+
+    def _hasIndex(self, table, columns):
+        """ check whether an index starts with the given columns """
+        fields = dict([(fld[0], fld[1].lower()) for fld in self.connector.getTableFields(table)])
+        wanted = [column.lower() for column in columns]
+        for num, name, unique, cols in self.connector.getTableIndexes(table):
+            if [fields.get(cid) for cid in cols[:len(wanted)]] == wanted:
+                return True
+        return False
+
+    def _estimateRows(self, table, columns, rows):
+        """ estimate the rows read through the index: a B-tree descent plus the
+            rows matching the first column, from its distinct count when the
+            column statistics are known, else 10% of the rows """
+        matching = rows * 0.1
+        cached = self.connector.getCachedColumnStatistics(table)
+        if cached is not None and columns[0] in cached[3]:
+            distinct = cached[3][columns[0]]['distinct']
+            if distinct > 0:
+                matching = float(rows) / distinct
+        return int(math.log(max(rows, 2), 2) + matching)
+
+    def clear(self):
+        with self._lock:
+            self._scans = {}
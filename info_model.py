@@ -20,10 +20,12 @@ email                   : cch@sourcepole.ch
  ***************************************************************************/
 """
 
+from urllib import quote
+
 from PyQt4.QtGui import QApplication
 
-from ..info_model import DatabaseInfo
-from ..html_elems import HtmlTable
+from ..info_model import DatabaseInfo, TableInfo, VectorTableInfo, RasterTableInfo
+from ..html_elems import HtmlTable, HtmlParagraph, HtmlSection
 
 
 class SLDatabaseInfo(DatabaseInfo):
@@ -45,3 +47,139 @@ class SLDatabaseInfo(DatabaseInfo):
 
     def privilegesDetails(self):
         return None
+
+    def statisticsDetails(self):
+        summary = self.db.connector.getStatisticsSummary()
+        if len(summary) == 0:
+            return None
+
+        tbl = [(QApplication.translate("DBManagerPlugin", "Table"),
+                QApplication.translate("DBManagerPlugin", "Columns"),
+                QApplication.translate("DBManagerPlugin", "Computed"),
+                QApplication.translate("DBManagerPlugin", "Sampled rows"))]
+        for name, columns, computed, sampled in summary:
+            tbl.append((name, columns, computed, sampled or QApplication.translate("DBManagerPlugin", "all")))
+        return HtmlTable(tbl, {"class": "header"})
+
+    def indexSuggestions(self):
+        suggestions = self.db.connector.indexAdvisor().suggestions()
+        if len(suggestions) == 0:
+            return None
+
+        tbl = [(QApplication.translate("DBManagerPlugin", "Table"),
+                QApplication.translate("DBManagerPlugin", "Columns"),
+                QApplication.translate("DBManagerPlugin", "Full scans"),
+                QApplication.translate("DBManagerPlugin", "Rows read per query"),
+                QApplication.translate("DBManagerPlugin", "With the index (est.)"),
+                u"")]
+        for table, columns, scans, rows, indexed in suggestions:
+            link = u'<a href="action:index/create/%s/%s">%s</a>' % (
+                quote(table.encode('utf-8')), ",".join([quote(column.encode('utf-8')) for column in columns]),
+                QApplication.translate("DBManagerPlugin", "create"))
+            tbl.append((table, u", ".join(columns), scans, rows, indexed, link))
+        return HtmlTable(tbl, {"class": "header"})
+
+    def toHtml(self):
+        ret = DatabaseInfo.toHtml(self)
+        stats = self.statisticsDetails()
+        if stats is not None:
+            ret += unicode(HtmlSection(QApplication.translate("DBManagerPlugin", 'Column statistics'), stats))
+        suggestions = self.indexSuggestions()
+        if suggestions is not None:
+            ret += unicode(HtmlSection(QApplication.translate("DBManagerPlugin", 'Index suggestions'), suggestions))
+        return ret
+
+
+def statisticsSection(table):
+    """ return the section showing the cached column statistics of table """
+    cached = table.database().connector.getCachedColumnStatistics((table.schemaName(), table.name))
+    ret = []
+    if cached is not None:
+        valid, computed, sampled, stats = cached
+        text = QApplication.translate("DBManagerPlugin", "Computed {0}").format(computed)
+        if sampled:
+            text += QApplication.translate("DBManagerPlugin", " from a sample of {0} rows").format(sampled)
+        if not valid:
+            text += QApplication.translate("DBManagerPlugin", ", the data may have changed since")
+        ret.append(HtmlParagraph(text))
+
+        tbl = [(QApplication.translate("DBManagerPlugin", "Column"),
+                QApplication.translate("DBManagerPlugin", "Values"),
+                QApplication.translate("DBManagerPlugin", "Nulls"),
+                QApplication.translate("DBManagerPlugin", "Distinct (approx.)"),
+                QApplication.translate("DBManagerPlugin", "Min"),
+                QApplication.translate("DBManagerPlugin", "Max"),
+                QApplication.translate("DBManagerPlugin", "Mean"),
+                QApplication.translate("DBManagerPlugin", "Histogram"))]
+        for fld in table.fields():
+            values = stats.get(fld.name)
+            if values is None:
+                continue
+            mean = u"%.6g" % values['mean'] if values['mean'] is not None else u""
+            tbl.append((fld.name, values['count'] - values['nulls'], values['nulls'], values['distinct'],
+                        values['min'], values['max'], mean, _sparkline(values['histogram'])))
+        ret.append(HtmlTable(tbl, {"class": "header"}))
+
+    ret.append(HtmlParagraph(QApplication.translate("DBManagerPlugin",
+                                                    '<a href="action:statistics/compute">Compute the statistics</a>, '
+                                                    '<a href="action:statistics/sample">from a sample</a>')))
+    return HtmlSection(QApplication.translate("DBManagerPlugin", 'Column statistics'), ret)
+
+
+def _sparkline(histogram):
+    if not histogram or max(histogram) == 0:
+        return u""
+    bars = u"\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+    top = float(max(histogram))
+    return u"".join([bars[int(round(n / top * (len(bars) - 1)))] for n in histogram])
+
+
+class SLTableInfo(TableInfo):
+    def __init__(self, table):
+        TableInfo.__init__(self, table)
+
+    def getTableInfo(self):
+        ret = TableInfo.getTableInfo(self)
+        ret.append(statisticsSection(self.table))
+        return ret
+
+
+class SLVectorTableInfo(VectorTableInfo):
+    def __init__(self, table):
+        VectorTableInfo.__init__(self, table)
+
+    def getTableInfo(self):
+        ret = VectorTableInfo.getTableInfo(self)
+        ret.append(statisticsSection(self.table))
+        return ret
+
+    def spatialInfo(self):
+        ret = VectorTableInfo.spatialInfo(self)
+        if self.table.geomType is None or self.table.isView:
+            return ret
+
+        if self.table.extent is not None and self.table.extent[0] is not None:
+            ret.append(HtmlParagraph(QApplication.translate("DBManagerPlugin",
+                                                            '<a href="action:extent/store">Store the extent in gpkg_contents</a>')))
+        return ret
+
+
+class SLRasterTableInfo(RasterTableInfo):
+    def __init__(self, table):
+        RasterTableInfo.__init__(self, table)
+
+    def spatialInfo(self):
+        ret = RasterTableInfo.spatialInfo(self)
+
+        tbl = [(QApplication.translate("DBManagerPlugin", "Zoom level"),
+                QApplication.translate("DBManagerPlugin", "Tiles"),
+                QApplication.translate("DBManagerPlugin", "Tile size"),
+                QApplication.translate("DBManagerPlugin", "Pixel size"))]
+        for zoom, width, height, tile_width, tile_height, pixel_x, pixel_y in self.table.tileMatrices():
+            tbl.append((zoom, u"%d x %d" % (width, height), u"%d x %d" % (tile_width, tile_height),
+                        u"%.10g x %.10g" % (pixel_x, pixel_y)))
+        ret.append(HtmlTable(tbl, {"class": "header"}))
+
+        ret.append(HtmlParagraph(QApplication.translate("DBManagerPlugin",
+                                                        '<a href="action:overviews/build">Build the missing zoom levels</a>')))
+        return ret
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+# Resampling of GeoPackage tile pyramids, run in worker processes: this module
+# must stay importable without Qt nor QGIS.
+
+import sqlite3
+import uuid
+
+from osgeo import gdal
+
+RESAMPLING_METHODS = ['average', 'near', 'bilinear', 'cubic', 'cubicspline', 'lanczos', 'mode']
+
+# the read connection of a worker process, see _connection()
+_connections = {}
+
+
+def _connection(dbname):
+    conn = _connections.get(dbname)
+    if conn is None:
+        conn = _connections[dbname] = sqlite3.connect(dbname, timeout=30)
+    return conn
+
+
+def _decodeTile(data):
+    """ return the tile as a MEM dataset and the bands giving its red, green,
+        blue and alpha (None: opaque) """
+    path = '/vsimem/tile_%s' % uuid.uuid4().hex
+    gdal.FileFromMemBuffer(path, str(data))
+    try:
+        ds = gdal.Open(path)
+        if ds is None:
+            return None, None
+        if ds.RasterCount == 1 and ds.GetRasterBand(1).GetColorTable() is not None:
+            ds = gdal.Translate('', ds, format='MEM', rgbExpand='rgba')
+        else:
+            ds = gdal.Translate('', ds, format='MEM')
+    finally:
+        gdal.Unlink(path)
+
+    bands = {1: (1, 1, 1, None), 2: (1, 1, 1, 2), 3: (1, 2, 3, None)}.get(ds.RasterCount, (1, 2, 3, 4))
+    return ds, bands
+
+
+def _encodeTile(ds, driver):
+    path = '/vsimem/tile_%s' % uuid.uuid4().hex
+    gdal.GetDriverByName(driver).CreateCopy(path, ds)
+    try:
+        f = gdal.VSIFOpenL(path, 'rb')
+        gdal.VSIFSeekL(f, 0, 2)
+        size = gdal.VSIFTellL(f)
+        gdal.VSIFSeekL(f, 0, 0)
+        data = gdal.VSIFReadL(1, size, f)
+        gdal.VSIFCloseL(f)
+    finally:
+        gdal.Unlink(path)
+    return data
+
+
+def renderBlock(args):
+    """ build the tiles of a block of the target zoom level from the 2x2
+        tiles below each of them in the source zoom level.
+        Return the number of tiles of the block and the list of
+        (column, row, tile data) built """
+    dbname, table, zoom, columns, rows, tile_width, tile_height, resampling, skip_existing = args
+    conn = _connection(dbname)
+    quoted = '"%s"' % table.replace('"', '""')
+
+    existing = set()
+    if skip_existing:
+        sql = "SELECT tile_column, tile_row FROM %s WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?" % quoted
+        existing = set(conn.execute(sql, (zoom, columns[0], columns[1], rows[0], rows[1])).fetchall())
+
+    sql = "SELECT tile_column, tile_row, tile_data FROM %s WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?" % quoted
+    sources = {}
+    for column, row, data in conn.execute(sql, (zoom + 1, columns[0] * 2, columns[1] * 2 + 1, rows[0] * 2, rows[1] * 2 + 1)):
+        sources[(column, row)] = data
+
+    tiles = []
+    for column in range(columns[0], columns[1] + 1):
+        for row in range(rows[0], rows[1] + 1):
+            if (column, row) in existing:
+                continue
+            quad = [((dx, dy), sources.get((column * 2 + dx, row * 2 + dy))) for dy in (0, 1) for dx in (0, 1)]
+            quad = [(pos, data) for pos, data in quad if data is not None]
+            if len(quad) == 0:
+                continue  # nothing below, no tile
+            data = _renderTile(quad, tile_width, tile_height, resampling)
+            if data is not None:
+                tiles.append((column, row, data))
+    return (columns[1] - columns[0] + 1) * (rows[1] - rows[0] + 1), tiles
+
+
+def _renderTile(quad, tile_width, tile_height, resampling):
+    """ mosaic up to 4 source tiles and resample them to a single tile """
+    mosaic = gdal.GetDriverByName('MEM').Create('', tile_width * 2, tile_height * 2, 4)
+    opaque = len(quad) == 4
+    jpeg = True
+    for (dx, dy), data in quad:
+        jpeg = jpeg and str(data[:2]) == '\xff\xd8'
+        ds, bands = _decodeTile(data)
+        if ds is None:
+            opaque = False
+            continue
+        width, height = min(ds.RasterXSize, tile_width), min(ds.RasterYSize, tile_height)
+        for i, band in enumerate(bands):
+            if band is None:
+                # no alpha band in the source tile
+                pixels = '\xff' * (width * height)
+            else:
+                pixels = ds.GetRasterBand(band).ReadRaster(0, 0, width, height, buf_type=gdal.GDT_Byte)
+                opaque = opaque and not (i == 3)
+            mosaic.GetRasterBand(i + 1).WriteRaster(dx * tile_width, dy * tile_height, width, height, pixels)
+    mosaic.GetRasterBand(4).SetColorInterpretation(gdal.GCI_AlphaBand)
+
+    tile = gdal.Translate('', mosaic, format='MEM', width=tile_width, height=tile_height, resampleAlg=resampling)
+    if opaque and jpeg:
+        # keep JPEG pyramids in JPEG, without the alpha band
+        return _encodeTile(gdal.Translate('', tile, format='MEM', bandList=[1, 2, 3]), 'JPEG')
+    return _encodeTile(tile, 'PNG')
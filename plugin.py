@@ -23,12 +23,14 @@ email                   : cch@sourcepole.ch
 # this will disable the dbplugin if the connector raise an ImportError
 from .connector import GeopackageDBConnector
 
+from urllib import unquote
+
 from PyQt4.QtCore import Qt,  QSettings
-from PyQt4.QtGui import QIcon, QApplication, QAction
+from PyQt4.QtGui import QIcon, QApplication, QAction, QFileDialog, QInputDialog, QMessageBox
 from qgis.gui import QgsMessageBar
 
 from ..plugin import DBPlugin, Database, Table, VectorTable, RasterTable, TableField, TableIndex, TableTrigger, \
-    InvalidDataException
+    InvalidDataException, DbError
 from ...db_plugins import createDbPlugin
 
 try:
@@ -115,25 +117,205 @@ class SLDatabase(Database):
     def registerDatabaseActions(self, mainWindow):
         action = QAction(self.tr("Run &Vacuum"), self)
         mainWindow.registerAction(action, self.tr("&Database"), self.runVacuumActionSlot)
+        action = QAction(self.tr("Run &Incremental Vacuum"), self)
+        mainWindow.registerAction(action, self.tr("&Database"), self.runIncrementalVacuumActionSlot)
+        action = QAction(self.tr("Enable Incremental Vacuum"), self)
+        mainWindow.registerAction(action, self.tr("&Database"), self.enableIncrementalVacuumActionSlot)
+        action = QAction(self.tr("GeoPackage &Catalog..."), self)
+        mainWindow.registerAction(action, self.tr("&Database"), self.catalogActionSlot)
+        action = QAction(self.tr("&Export Table..."), self)
+        mainWindow.registerAction(action, self.tr("&Table"), self.exportTableActionSlot)
+        action = QAction(self.tr("Build &Overviews..."), self)
+        mainWindow.registerAction(action, self.tr("&Table"), self.buildOverviewsActionSlot)
+        action = QAction(self.tr("&Filter Data..."), self)
+        mainWindow.registerAction(action, self.tr("&Table"), self.filterDataActionSlot)
+        action = QAction(self.tr("Filter Data by Map &Extent"), self)
+        mainWindow.registerAction(action, self.tr("&Table"), self.filterByCanvasActionSlot)
 
         Database.registerDatabaseActions(self, mainWindow)
 
-    def runVacuumActionSlot(self, item, action, parent):
+    def _checkDatabaseItem(self, item, parent):
         QApplication.restoreOverrideCursor()
         try:
             if not isinstance(item, (DBPlugin, Table)) or item.database() is None:
                 parent.infoBar.pushMessage(self.tr("No database selected or you are not connected to it."),
                                            QgsMessageBar.INFO, parent.iface.messageTimeout())
+                return False
+        finally:
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+        return True
+
+    def runVacuumActionSlot(self, item, action, parent):
+        if self._checkDatabaseItem(item, parent):
+            self.runVacuum(parent)
+
+    def runIncrementalVacuumActionSlot(self, item, action, parent):
+        if self._checkDatabaseItem(item, parent):
+            self.runIncrementalVacuum(parent)
+
+    def enableIncrementalVacuumActionSlot(self, item, action, parent):
+        if self._checkDatabaseItem(item, parent):
+            self.enableIncrementalVacuum(parent)
+
+    def catalogActionSlot(self, item, action, parent):
+        from .catalog_dialog import CatalogDialog
+
+        QApplication.restoreOverrideCursor()
+        try:
+            dlg = CatalogDialog(parent.iface, parent)
+            dlg.exec_()
+            dlg.closeCatalog()
+            dlg.deleteLater()
+        finally:
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+
+    def exportTableActionSlot(self, item, action, parent):
+        QApplication.restoreOverrideCursor()
+        try:
+            if not isinstance(item, Table):
+                parent.infoBar.pushMessage(self.tr("Select a table to export."),
+                                           QgsMessageBar.INFO, parent.iface.messageTimeout())
+                return
+
+            dest = QFileDialog.getSaveFileName(parent, self.tr("Export table"), item.name,
+                                               self.tr("FlatGeobuf (*.fgb);;GeoParquet (*.parquet);;CSV (*.csv)"))
+            if not dest:
+                return
+            split_rows, ok = QInputDialog.getInt(parent, self.tr("Export table"),
+                                                 self.tr("Rows per file (0: a single file)"), 0, 0)
+            if not ok:
                 return
         finally:
             QApplication.setOverrideCursor(Qt.WaitCursor)
 
-        self.runVacuum()
+        item.exportData(unicode(dest), split_rows=split_rows or None, parent=parent)
+
+    def buildOverviewsActionSlot(self, item, action, parent):
+        from .overviews import RESAMPLING_METHODS
+
+        QApplication.restoreOverrideCursor()
+        try:
+            if not isinstance(item, RasterTable):
+                parent.infoBar.pushMessage(self.tr("Select a tile table to build its overviews."),
+                                           QgsMessageBar.INFO, parent.iface.messageTimeout())
+                return
+
+            resampling, ok = QInputDialog.getItem(parent, self.tr("Build overviews"), self.tr("Resampling method"),
+                                                  RESAMPLING_METHODS, 0, False)
+            if not ok:
+                return
+        finally:
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+
+        item.buildOverviews(unicode(resampling), parent=parent)
+
+    def filterDataActionSlot(self, item, action, parent):
+        QApplication.restoreOverrideCursor()
+        try:
+            if not isinstance(item, SLTable):
+                parent.infoBar.pushMessage(self.tr("Select a table to filter its data."),
+                                           QgsMessageBar.INFO, parent.iface.messageTimeout())
+                return
+
+            expression, ok = QInputDialog.getText(parent, self.tr("Filter data"),
+                                                  self.tr("SQL condition (empty: all the rows)"),
+                                                  text=item.filterExpression or "")
+            if not ok:
+                return
+        finally:
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+
+        expression = unicode(expression).strip() or None
+        if expression is not None:
+            try:
+                self.connector.checkFilterExpression((item.schemaName(), item.name), expression)
+            except DbError, e:
+                parent.infoBar.pushMessage(unicode(e), QgsMessageBar.CRITICAL, parent.iface.messageTimeout())
+                return
+
+        # the data tab is reloaded with the new filter
+        item.filterExpression = expression
+        item.refresh()
+
+    def filterByCanvasActionSlot(self, item, action, parent):
+        if not isinstance(item, SLVectorTable):
+            QApplication.restoreOverrideCursor()
+            try:
+                parent.infoBar.pushMessage(self.tr("Select a vector table to filter its data."),
+                                           QgsMessageBar.INFO, parent.iface.messageTimeout())
+            finally:
+                QApplication.setOverrideCursor(Qt.WaitCursor)
+            return
+
+        # toggle, the data tab is reloaded with the new filter
+        item.filterCanvas = parent.iface.mapCanvas() if item.filterCanvas is None else None
+        item.refresh()
+
+    def _runMaintenance(self, func, label, parent=None):
+        """ run a maintenance function of the connector in background """
+        from .tasks import runTask
+
+        connector = self.database().connector
+
+        def run(progress):
+            try:
+                return func(progress)
+            finally:
+                connector._releaseReadConnection()
+
+        def finished(task):
+            self.database().refresh()
+            if task.error is not None and parent is not None:
+                parent.infoBar.pushMessage(unicode(task.error), QgsMessageBar.CRITICAL, parent.iface.messageTimeout())
 
-    def runVacuum(self):
         self.database().aboutToChange()
-        self.database().connector.runVacuum()
-        self.database().refresh()
+        return runTask(run, label, parent, finished)
+
+    def runVacuum(self, parent=None):
+        connector = self.database().connector
+        return self._runMaintenance(connector.runVacuum, self.tr("Running vacuum..."), parent)
+
+    def runIncrementalVacuum(self, parent=None, pages=1000):
+        connector = self.database().connector
+        return self._runMaintenance(lambda progress: connector.runIncrementalVacuum(pages, progress),
+                                    self.tr("Reclaiming free pages..."), parent)
+
+    def enableIncrementalVacuum(self, parent=None):
+        connector = self.database().connector
+        return self._runMaintenance(connector.enableIncrementalVacuum,
+                                    self.tr("Switching to incremental vacuum..."), parent)
+
+
+    def exportData(self, dest, table=None, sql=None, format=None, split_rows=None, parent=None):
+        """ export a table or the result of a query in background, see
+            GeopackageDBConnector.exportData() """
+        from .tasks import runTask
+
+        connector = self.connector
+
+        def export(progress):
+            try:
+                return connector.exportData(dest, table, sql, format, split_rows, progress=progress)
+            finally:
+                connector._releaseReadConnection()
+
+        def finished(task):
+            if parent is None:
+                return
+            # the SQL window has no message bar
+            if task.error is not None:
+                if hasattr(parent, 'infoBar'):
+                    parent.infoBar.pushMessage(unicode(task.error), QgsMessageBar.CRITICAL, parent.iface.messageTimeout())
+                else:
+                    QMessageBox.warning(parent, self.tr("Export"), unicode(task.error))
+            elif task.result:
+                message = self.tr("Exported to {0}").format(", ".join(task.result))
+                if hasattr(parent, 'infoBar'):
+                    parent.infoBar.pushMessage(message, QgsMessageBar.INFO, parent.iface.messageTimeout())
+                else:
+                    QMessageBox.information(parent, self.tr("Export"), message)
+
+        return runTask(export, self.tr("Exporting..."), parent, finished)
 
 
     def runAction(self, action):
@@ -143,6 +325,19 @@ class SLDatabase(Database):
             if action == "vacuum/run":
                 self.runVacuum()
                 return True
+            if action == "vacuum/incremental":
+                self.runIncrementalVacuum()
+                return True
+
+        if action.startswith("index/create/"):
+            # index/create/<table>/<column>,<column>... from the index suggestions
+            table, columns = action[len("index/create/"):].split("/", 1)
+            table = unquote(table.encode('utf-8')).decode('utf-8')
+            columns = [unquote(column.encode('utf-8')).decode('utf-8') for column in columns.split(",")]
+            self.aboutToChange()
+            self.connector.createTableIndex(table, u"idx_%s_%s" % (table, "_".join(columns)), columns)
+            self.refresh()
+            return True
 
         return Database.runAction(self, action)
 
@@ -150,16 +345,31 @@ class SLDatabase(Database):
         return None
 
     def explicitSpatialIndex( self ):
-        return True
+        # the R-tree indexes are regular virtual tables, they must be queried explicitly
+        return self.connector.has_geometry_columns
 
     def spatialIndexClause( self, src_table, src_column, dest_table, dest_column ):
-        return """"%s".ROWID IN (\nSELECT ROWID FROM SpatialIndex WHERE f_table_name='%s' AND search_frame="%s"."%s") """ % (src_table,src_table,dest_table, dest_column)
+        """ restrict src_table to the rows whose bbox overlaps the one of
+            dest_table.dest_column, using the R-tree index of src_column """
+        connector = self.connector
+        if not connector.hasSpatialIndex(src_table, src_column):
+            return ""
+
+        fid = connector.getTableFidColumn(src_table) or "ROWID"
+        dest = "%s.%s" % (connector.quoteId(dest_table), connector.quoteId(dest_column))
+        return """%(src)s.%(fid)s IN (\nSELECT id FROM %(rtree)s WHERE minx <= ST_MaxX(%(dest)s) AND maxx >= ST_MinX(%(dest)s) AND miny <= ST_MaxY(%(dest)s) AND maxy >= ST_MinY(%(dest)s)) """ % {
+            'src': connector.quoteId(src_table), 'fid': connector.quoteId(fid),
+            'rtree': connector.quoteId("rtree_%s_%s" % (src_table, src_column)), 'dest': dest}
 
 class SLTable(Table):
+    # rows read by the sampled column statistics
+    STATISTICS_SAMPLE_ROWS = 100000
+
     def __init__(self, row, db, schema=None):
         Table.__init__(self, db, None)
-        self.name, self.isView = row
-        self.name = self.name.GetName()
+        self.name, self.isView, self.isSysTable = row
+        # SQL condition filtering the data tab, see tableDataModel()
+        self.filterExpression = None
 
 
     def tableFieldsFactory(self, row, table):
@@ -175,7 +385,42 @@ class SLTable(Table):
     def tableDataModel(self, parent):
         from .data_model import SLTableDataModel
 
-        return SLTableDataModel(self, parent)
+        model = SLTableDataModel(self, parent)
+        if self.filterExpression is not None:
+            try:
+                model.setFilterExpression(self.filterExpression)
+            except DbError:
+                self.filterExpression = None
+        return model
+
+    def info(self):
+        from .info_model import SLTableInfo
+
+        return SLTableInfo(self)
+
+    def computeStatistics(self, sample_rows=None, parent=None):
+        """ profile the columns in background, the info tab shows the result """
+        connector = self.database().connector
+        table = (self.schemaName(), self.name)
+        return self.database()._runMaintenance(
+            lambda progress: connector.getColumnStatistics(table, sample_rows, progress),
+            QApplication.translate("DBManagerPlugin", "Computing column statistics..."), parent)
+
+    def runAction(self, action):
+        action = unicode(action)
+
+        if action == "statistics/compute":
+            self.computeStatistics()
+            return True
+        if action == "statistics/sample":
+            self.computeStatistics(self.STATISTICS_SAMPLE_ROWS)
+            return True
+
+        return Table.runAction(self, action)
+
+    def exportData(self, dest, format=None, split_rows=None, parent=None):
+        """ stream the table to a FlatGeobuf, GeoParquet or CSV file """
+        return self.database().exportData(dest, (self.schemaName(), self.name), None, format, split_rows, parent)
 
 
 class SLVectorTable(SLTable, VectorTable):
@@ -186,6 +431,8 @@ class SLVectorTable(SLTable, VectorTable):
         # SL provider didn't do the same in QGis < 1.9, so self.geomTableName
         # stores the table name like stored in the geometry_columns table
         self.geomTableName, self.geomColumn, self.geomType, self.geomDim, self.srid = row[-5:]
+        # map canvas whose extent filters the data tab, see tableDataModel()
+        self.filterCanvas = None
 
     def uri(self):
         uri = self.database().uri()
@@ -213,8 +460,30 @@ class SLVectorTable(SLTable, VectorTable):
     def refreshTableEstimatedExtent(self):
         return
 
+    def tableDataModel(self, parent):
+        model = SLTable.tableDataModel(self, parent)
+        if self.filterCanvas is not None:
+            model.followCanvas(self.filterCanvas)
+        return model
+
+    def storeTableExtent(self):
+        """ write the computed extent to gpkg_contents """
+        self.aboutToChange()
+        self.database().connector.updateTableExtent((self.schemaName(), self.name), self.geomColumn)
+        self.refreshTableExtent()
+
+    def info(self):
+        from .info_model import SLVectorTableInfo
+
+        return SLVectorTableInfo(self)
 
     def runAction(self, action):
+        action = unicode(action)
+
+        if action == "extent/store":
+            self.storeTableExtent()
+            return True
+
         if SLTable.runAction(self, action):
             return True
         return VectorTable.runAction(self, action)
@@ -227,13 +496,36 @@ class SLRasterTable(SLTable, RasterTable):
         self.prefixName, self.geomColumn, self.srid = row[-3:]
         self.geomType = 'RASTER'
 
-        # def info(self):
-        #from .info_model import SLRasterTableInfo
-        #return SLRasterTableInfo(self)
+    def info(self):
+        from .info_model import SLRasterTableInfo
+
+        return SLRasterTableInfo(self)
+
+    def tileMatrices(self):
+        return self.database().connector.getTileMatrices((self.schemaName(), self.name))
+
+    def buildOverviews(self, resampling='average', resume=True, parent=None):
+        """ build the missing zoom levels in background """
+        connector = self.database().connector
+        table = (self.schemaName(), self.name)
+        return self.database()._runMaintenance(
+            lambda progress: connector.buildTileOverviews(table, resampling, resume=resume, progress=progress),
+            QApplication.translate("DBManagerPlugin", "Building overviews..."), parent)
+
+    def runAction(self, action):
+        action = unicode(action)
+
+        if action == "overviews/build":
+            self.buildOverviews()
+            return True
+
+        if SLTable.runAction(self, action):
+            return True
+        return RasterTable.runAction(self, action)
 
     def gdalUri(self):
         uri = self.database().uri()
-        gdalUri = u'RASTERLITE:%s,table=%s' % (uri.database(), self.prefixName)
+        gdalUri = u'GPKG:%s:%s' % (uri.database(), self.prefixName)
         return gdalUri
 
     def mimeUri(self):
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+# Column statistics computed in a single pass over the rows: exact counts,
+# min, max and mean, approximate distinct count and histogram.
+
+import math
+import random
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix(h):
+    """ spread the bits of a Python hash over 64 bits (splitmix64 finalizer) """
+    h &= _MASK64
+    h ^= h >> 30
+    h = (h * 0xbf58476d1ce4e5b9) & _MASK64
+    h ^= h >> 27
+    h = (h * 0x94d049bb133111eb) & _MASK64
+    return h ^ (h >> 31)
+
+
+class HyperLogLog(object):
+    """ approximate distinct counter, the standard error is 1.04 / sqrt(2^p):
+        1.6% with the default 4096 registers """
+
+    def __init__(self, p=12):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+        self._bits = 64 - p
+
+    def add(self, value):
+        h = _mix(hash(value))
+        idx = h >> self._bits
+        rank = self._bits - (h & ((1 << self._bits) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def count(self):
+        m = float(self.m)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum([2.0 ** -r for r in self.registers])
+        zeros = self.registers.count(b'\x00')
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros)  # linear counting for small sets
+        return int(round(estimate))
+
+
+class ColumnProfile(object):
+    """ statistics of the values of one column, fed with add() """
+    # numeric values kept to draw the histogram
+    SAMPLE_SIZE = 10000
+    HISTOGRAM_BINS = 10
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.blobs = 0
+        self.min = None
+        self.max = None
+        self.numeric = 0
+        self.total = 0.0
+        self.distinct = HyperLogLog()
+        self._sample = []
+        self._random = random.Random(0)
+
+    def add(self, value):
+        self.count += 1
+        if value is None:
+            self.nulls += 1
+            return
+        if isinstance(value, buffer):
+            self.blobs += 1  # geometries and other blobs are only counted
+            return
+
+        self.distinct.add(value)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if isinstance(value, (int, long, float)):
+            self.numeric += 1
+            self.total += value
+            # reservoir sampling, every value has the same chance to be kept
+            if len(self._sample) < self.SAMPLE_SIZE:
+                self._sample.append(value)
+            else:
+                i = self._random.randint(0, self.numeric - 1)
+                if i < self.SAMPLE_SIZE:
+                    self._sample[i] = value
+
+    def histogram(self):
+        """ return the count of numeric values per bin between min and max,
+            estimated from the sample """
+        if self.numeric == 0 or not isinstance(self.min, (int, long, float)):
+            return None
+        low, high = min(self._sample), max(self._sample)
+        bins = [0] * self.HISTOGRAM_BINS
+        width = float(high - low) / self.HISTOGRAM_BINS
+        for value in self._sample:
+            i = int((value - low) / width) if width > 0 else 0
+            bins[min(i, self.HISTOGRAM_BINS - 1)] += 1
+        scale = float(self.numeric) / len(self._sample)
+        return [int(round(n * scale)) for n in bins]
+
+    def result(self, scale=1.0):
+        """ return the statistics as a dict, counts multiplied by scale when
+            the values are a sample of the rows """
+        histogram = self.histogram()
+        return {
+            'count': int(round(self.count * scale)),
+            'nulls': int(round(self.nulls * scale)),
+            'blobs': int(round(self.blobs * scale)),
+            'distinct': min(self.distinct.count(), self.count - self.nulls - self.blobs),
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.numeric if self.numeric > 0 else None,
+            'histogram': [int(round(n * scale)) for n in histogram] if histogram is not None else None,
+        }
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from PyQt4.QtCore import Qt, QThread, pyqtSignal
+from PyQt4.QtGui import QApplication, QProgressDialog
+
+
+class TaskThread(QThread):
+    """ run func(progress) in a thread. func reports with progress(done, total),
+        which returns True once the task has been cancelled """
+    progressChanged = pyqtSignal(object, object)
+
+    def __init__(self, func, parent=None):
+        QThread.__init__(self, parent)
+        self.func = func
+        self.result = None
+        self.error = None
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def isCancelled(self):
+        return self._cancelled
+
+    def _progress(self, done, total):
+        self.progressChanged.emit(done, total)
+        return self._cancelled
+
+    def run(self):
+        try:
+            self.result = self.func(self._progress)
+        except Exception, e:
+            self.error = e
+
+
+def runTask(func, label, parent=None, finished=None):
+    """ run func in a TaskThread, showing a non modal progress dialog with a
+        cancel button. finished(task) is called in the GUI thread at the end """
+    dlg = QProgressDialog(label, QApplication.translate("DBManagerPlugin", "Cancel"), 0, 0, parent)
+    dlg.setWindowModality(Qt.NonModal)
+    dlg.setMinimumDuration(500)
+
+    task = TaskThread(func, dlg)
+
+    def updateProgress(done, total):
+        # total = 0 shows a busy indicator
+        if total > 0:
+            dlg.setMaximum(1000)
+            dlg.setValue(int(1000 * done / total))
+
+    def taskFinished():
+        dlg.reset()
+        if finished is not None:
+            finished(task)
+        dlg.deleteLater()
+
+    dlg.canceled.connect(task.cancel)
+    task.progressChanged.connect(updateProgress)
+    task.finished.connect(taskFinished)
+    task.start()
+    return task
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                  : DB Manager
+Description          : Database manager plugin for QGIS (ogr)
+Date                    : June 25, 2015
+copyright            : (C) 2015 by Cédric Christen
+email                   : cch@sourcepole.ch
+
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy
+    from osgeo import ogr, osr
+    from qgis.core import QgsDataSourceURI
+    from ..connector import GeopackageDBConnector
+except ImportError:
+    GeopackageDBConnector = None
+
+
+@unittest.skipIf(GeopackageDBConnector is None, "needs GDAL, NumPy and QGIS")
+class ColumnBatchesTest(unittest.TestCase):
+    """ getColumnBatches() on a table with NULLs, the Arrow and the SQLite
+        paths must give the same columns """
+    VALUES = [(1, 1.5, u"a"), (None, None, u"b"), (3, 3.5, None), (None, 4.5, u"d")]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="gpkg-tests-")
+        path = os.path.join(self.dir, "batches.gpkg")
+        ds = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        lyr = ds.CreateLayer('pts', srs, ogr.wkbPoint)
+        lyr.CreateField(ogr.FieldDefn('count', ogr.OFTInteger))
+        lyr.CreateField(ogr.FieldDefn('value', ogr.OFTReal))
+        lyr.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+        for i, values in enumerate(self.VALUES):
+            feat = ogr.Feature(lyr.GetLayerDefn())
+            for j, value in enumerate(values):
+                if value is not None:
+                    feat.SetField(j, value)
+            feat.SetGeometry(ogr.CreateGeometryFromWkt("POINT (%d %d)" % (i, -i)))
+            lyr.CreateFeature(feat)
+        ds = None
+
+        uri = QgsDataSourceURI()
+        uri.setDatabase(path)
+        self.connector = GeopackageDBConnector(uri)
+
+    def tearDown(self):
+        self.connector = None  # releases the datasources
+        shutil.rmtree(self.dir)
+
+    def batches(self, **kwargs):
+        """ return the batches of both paths, concatenated column by column """
+        results = []
+        for func in (self.connector.getColumnBatches, self.connector._sqliteBatches):
+            args = dict(table=None, sql=None, columns=None, batch_size=3)
+            args.update(kwargs)
+            columns = {}
+            for batch in func(**args):
+                for name, values in batch.items():
+                    columns.setdefault(name, []).extend(numpy.ma.filled(numpy.ma.array(values, dtype=object), None)
+                                                        if isinstance(values, numpy.ndarray) else values)
+            results.append(columns)
+        return results
+
+    def testNullsAreMasked(self):
+        for columns in self.batches(table='pts'):
+            self.assertEqual(columns['count'], [row[0] for row in self.VALUES])
+            self.assertEqual(columns['value'], [row[1] for row in self.VALUES])
+            self.assertEqual(columns['name'], [row[2] for row in self.VALUES])
+
+    def testColumnSubsetKeepsFid(self):
+        for columns in self.batches(table='pts', columns=['value']):
+            self.assertEqual(sorted(columns.keys()), ['fid', 'value'])
+            self.assertEqual(columns['fid'], [1, 2, 3, 4])
+            self.assertEqual(columns['value'], [row[1] for row in self.VALUES])
+
+    def testQueryColumnSubsetKeepsFid(self):
+        for columns in self.batches(sql="SELECT fid, count, value FROM pts WHERE fid > 1", columns=['count']):
+            self.assertEqual(sorted(columns.keys()), ['count', 'fid'])
+            self.assertEqual(columns['fid'], [2, 3, 4])
+            self.assertEqual(columns['count'], [row[0] for row in self.VALUES[1:]])
+
+
+if __name__ == '__main__':
+    unittest.main()